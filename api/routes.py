@@ -1,26 +1,90 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, g
 from backend.auth.auth_manager import AuthManager
+from backend.api.responses import ojsonify
+from backend.notifications.tasks import dispatch_alert, submit_or_delay
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError
 from functools import wraps
+from cachetools import TTLCache
+import hashlib
+import shutil
+import threading
+import time
 import os
+from pathlib import Path
+from werkzeug.utils import secure_filename
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 auth_manager = AuthManager()
 
+VIDEO_ROOT = Path(os.getenv('VIDEO_ROOT', '/videos')).resolve()
+
+# Cache verified JWT payloads for a short window so repeat requests from the
+# same client skip signature verification. Keyed by SHA-256 of the token so
+# raw credentials never sit in memory.
+_jwt_cache = TTLCache(maxsize=10000, ttl=30)
+_jwt_cache_lock = threading.RLock()
+
+# A request checks its connection out of the pool lazily, on first DB
+# use: token-only endpoints like /auth/verify never consume a slot, and
+# login/register go through auth_manager's own checkout. The pool holds
+# far fewer connections (20) than the gevent config allows concurrent
+# requests (1000), so exhaustion waits for a free slot up to a deadline
+# instead of failing straight into PoolError 500s.
+_DB_ACQUIRE_TIMEOUT_SECONDS = 5.0
+
+def get_db():
+    """Return this request's pooled connection, checking one out on first use"""
+    if 'db' not in g:
+        deadline = time.monotonic() + _DB_ACQUIRE_TIMEOUT_SECONDS
+        while True:
+            try:
+                g.db = auth_manager.db_pool.getconn()
+                break
+            except PoolError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)  # yields the greenlet under gevent
+
+    return g.db
+
+def _rollback_db():
+    """Roll back this request's connection, if it ever checked one out"""
+    db = g.get('db')
+    if db is not None:
+        db.rollback()
+
+@api_bp.teardown_request
+def _return_db_connection(exc):
+    db = g.pop('db', None)
+    if db is not None:
+        auth_manager.db_pool.putconn(db)
+
 # Middleware to verify JWT token
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if not token:
-            return jsonify({'error': 'Missing token'}), 401
-        
+        auth = request.headers.get('Authorization', '')
+        if not auth.startswith('Bearer '):
+            return ojsonify({'error': 'Missing token'}, 401)
+
+        token = auth[7:]  # strip 'Bearer ' without list allocation
         try:
-            token = token.split(' ')[1]  # Remove 'Bearer ' prefix
-            payload = auth_manager.verify_token(token)
+            key = hashlib.sha256(token.encode()).digest()
+
+            with _jwt_cache_lock:
+                payload = _jwt_cache.get(key)
+
+            # Cached entries may outlive the token itself; honor 'exp'
+            if payload is None or payload.get('exp', 0) <= time.time():
+                payload = auth_manager.verify_token(token)
+                with _jwt_cache_lock:
+                    _jwt_cache[key] = payload
+
             request.user = payload
         except Exception as e:
-            return jsonify({'error': str(e)}), 401
-        
+            return ojsonify({'error': str(e)}, 401)
+
         return f(*args, **kwargs)
     return decorated
 
@@ -38,9 +102,9 @@ def register():
             role=data.get('role', 'traffic_inspector')
         )
         
-        return jsonify(result), 201
+        return ojsonify(result, 201)
     except Exception as e:
-        return jsonify({'error': str(e)}), 400
+        return ojsonify({'error': str(e)}, 400)
 
 @api_bp.route('/auth/login', methods=['POST'])
 def login():
@@ -52,37 +116,36 @@ def login():
             password=data.get('password')
         )
         
-        return jsonify(result), 200
+        return ojsonify(result, 200)
     except Exception as e:
-        return jsonify({'error': str(e)}), 401
+        return ojsonify({'error': str(e)}, 401)
 
 @api_bp.route('/auth/verify', methods=['GET'])
 @token_required
 def verify_token():
-    return jsonify({'user': request.user}), 200
+    return ojsonify({'user': request.user}, 200)
 
 # Inspectors Routes
 @api_bp.route('/inspectors', methods=['GET'])
 @token_required
 def get_inspectors():
     try:
-        cursor = auth_manager.db_connection.cursor()
-        cursor.execute("""
-            SELECT i.id, i.badge_number, u.full_name, u.email, i.phone_number,
-                   i.email_notification_enabled, i.sms_notification_enabled,
-                   j.name as junction_name
-            FROM inspectors i
-            JOIN users u ON i.user_id = u.id
-            JOIN junctions j ON i.junction_id = j.id
-            WHERE i.user_id = %s OR %s = 'admin'
-        """, (request.user['user_id'], request.user['role']))
-        
-        inspectors = cursor.fetchall()
-        cursor.close()
-        
-        return jsonify([dict(i) for i in inspectors]), 200
+        with get_db().cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                SELECT i.id, i.badge_number, u.full_name, u.email, i.phone_number,
+                       i.email_notification_enabled, i.sms_notification_enabled,
+                       j.name as junction_name
+                FROM inspectors i
+                JOIN users u ON i.user_id = u.id
+                JOIN junctions j ON i.junction_id = j.id
+                WHERE i.user_id = %s OR %s = 'admin'
+            """, (request.user['user_id'], request.user['role']))
+
+            inspectors = cursor.fetchall()
+
+        return ojsonify(inspectors, 200)
     except Exception as e:
-        return jsonify({'error': str(e)}), 400
+        return ojsonify({'error': str(e)}, 400)
 
 @api_bp.route('/inspectors', methods=['POST'])
 @token_required
@@ -90,44 +153,58 @@ def add_inspector():
     try:
         data = request.get_json()
         
-        cursor = auth_manager.db_connection.cursor()
-        cursor.execute("""
-            INSERT INTO inspectors (user_id, junction_id, badge_number, phone_number)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-        """, (data['user_id'], data['junction_id'], data['badge_number'], data['phone_number']))
-        
-        inspector_id = cursor.fetchone()[0]
-        auth_manager.db_connection.commit()
-        cursor.close()
-        
-        return jsonify({'id': str(inspector_id), 'message': 'Inspector added'}), 201
+        with get_db().cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO inspectors (user_id, junction_id, badge_number, phone_number)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id
+            """, (data['user_id'], data['junction_id'], data['badge_number'], data['phone_number']))
+
+            inspector_id = cursor.fetchone()[0]
+        get_db().commit()
+
+        return ojsonify({'id': str(inspector_id), 'message': 'Inspector added'}, 201)
     except Exception as e:
-        auth_manager.db_connection.rollback()
-        return jsonify({'error': str(e)}), 400
+        _rollback_db()
+        return ojsonify({'error': str(e)}, 400)
 
 # Alerts Routes
 @api_bp.route('/alerts', methods=['GET'])
 @token_required
 def get_alerts():
     try:
-        cursor = auth_manager.db_connection.cursor()
-        cursor.execute("""
-            SELECT a.id, a.title, a.description, a.severity, a.alert_type,
-                   a.created_at, j.name as junction_name
-            FROM alerts a
-            JOIN junctions j ON a.junction_id = j.id
-            WHERE a.is_active = TRUE
-            ORDER BY a.created_at DESC
-            LIMIT 50
-        """)
-        
-        alerts = cursor.fetchall()
-        cursor.close()
-        
-        return jsonify([dict(a) for a in alerts]), 200
+        limit = min(request.args.get('limit', 50, type=int), 200)
+        before = request.args.get('before')
+
+        with get_db().cursor(cursor_factory=RealDictCursor) as cursor:
+            # Keyset pagination: seek on created_at instead of OFFSET
+            if before:
+                cursor.execute("""
+                    SELECT a.id, a.title, a.description, a.severity, a.alert_type,
+                           a.created_at, j.name as junction_name
+                    FROM alerts a
+                    JOIN junctions j ON a.junction_id = j.id
+                    WHERE a.is_active = TRUE AND a.created_at < %s
+                    ORDER BY a.created_at DESC
+                    LIMIT %s
+                """, (before, limit))
+            else:
+                cursor.execute("""
+                    SELECT a.id, a.title, a.description, a.severity, a.alert_type,
+                           a.created_at, j.name as junction_name
+                    FROM alerts a
+                    JOIN junctions j ON a.junction_id = j.id
+                    WHERE a.is_active = TRUE
+                    ORDER BY a.created_at DESC
+                    LIMIT %s
+                """, (limit,))
+
+            alerts = cursor.fetchall()
+
+        next_before = alerts[-1]['created_at'] if len(alerts) == limit else None
+        return ojsonify({'items': alerts, 'next_before': next_before}, 200)
     except Exception as e:
-        return jsonify({'error': str(e)}), 400
+        return ojsonify({'error': str(e)}, 400)
 
 @api_bp.route('/alerts', methods=['POST'])
 @token_required
@@ -135,49 +212,33 @@ def create_alert():
     try:
         data = request.get_json()
         
-        cursor = auth_manager.db_connection.cursor()
-        cursor.execute("""
-            INSERT INTO alerts (junction_id, alert_type, severity, title, description, created_by)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (
-            data['junction_id'],
-            data['alert_type'],
-            data['severity'],
-            data['title'],
-            data.get('description'),
-            request.user['user_id']
-        ))
-        
-        alert_id = cursor.fetchone()[0]
-        auth_manager.db_connection.commit()
-        
-        # Send notifications to inspectors
-        cursor.execute("""
-            SELECT i.id, u.email, i.phone_number, i.email_notification_enabled, 
-                   i.sms_notification_enabled
-            FROM inspectors i
-            JOIN users u ON i.user_id = u.id
-            WHERE i.junction_id = %s
-        """, (data['junction_id'],))
-        
-        inspectors = cursor.fetchall()
-        for inspector in inspectors:
-            if inspector[3]:  # email_notification_enabled
-                auth_manager.send_notification_email(
-                    inspector[1],
-                    f"Alert: {data['title']}",
-                    data.get('description', '')
-                )
-            if inspector[4]:  # sms_notification_enabled
-                auth_manager.send_sms(inspector[2], data['title'])
-        
-        cursor.close()
-        
-        return jsonify({'id': str(alert_id), 'message': 'Alert created'}), 201
+        with get_db().cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO alerts (junction_id, alert_type, severity, title, description, created_by)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING id
+            """, (
+                data['junction_id'],
+                data['alert_type'],
+                data['severity'],
+                data['title'],
+                data.get('description'),
+                request.user['user_id']
+            ))
+
+            alert_id = cursor.fetchone()[0]
+        get_db().commit()
+
+        # Fan notifications out on the worker queues; don't block the response
+        submit_or_delay(
+            dispatch_alert,
+            str(alert_id), data['junction_id'], data['title'], data.get('description')
+        )
+
+        return ojsonify({'id': str(alert_id), 'message': 'Alert created'}, 201)
     except Exception as e:
-        auth_manager.db_connection.rollback()
-        return jsonify({'error': str(e)}), 400
+        _rollback_db()
+        return ojsonify({'error': str(e)}, 400)
 
 # Video Feed Routes
 @api_bp.route('/video-feeds', methods=['POST'])
@@ -185,31 +246,37 @@ def create_alert():
 def upload_video_feed():
     try:
         if 'video' not in request.files:
-            return jsonify({'error': 'No video provided'}), 400
+            return ojsonify({'error': 'No video provided'}, 400)
         
         video_file = request.files['video']
         junction_id = request.form.get('junction_id')
         feed_name = request.form.get('feed_name')
         
-        # Save video file
-        video_path = f"/videos/{junction_id}/{video_file.filename}"
-        video_file.save(video_path)
-        
-        cursor = auth_manager.db_connection.cursor()
-        cursor.execute("""
-            INSERT INTO video_feeds (junction_id, feed_name, feed_type, source_path)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-        """, (junction_id, feed_name, 'upload', video_path))
-        
-        feed_id = cursor.fetchone()[0]
-        auth_manager.db_connection.commit()
-        cursor.close()
-        
-        return jsonify({'id': str(feed_id), 'message': 'Video uploaded'}), 201
+        # Resolve the destination under VIDEO_ROOT before writing
+        filename = secure_filename(video_file.filename)
+        video_path = (VIDEO_ROOT / str(junction_id) / filename).resolve()
+        if VIDEO_ROOT not in video_path.parents:
+            return ojsonify({'error': 'Invalid file path'}, 400)
+
+        # Stream video to disk in fixed-size chunks (constant memory)
+        os.makedirs(video_path.parent, exist_ok=True)
+        with open(video_path, 'wb') as dst:
+            shutil.copyfileobj(video_file.stream, dst, length=4 * 1024 * 1024)
+        
+        with get_db().cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO video_feeds (junction_id, feed_name, feed_type, source_path)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id
+            """, (junction_id, feed_name, 'upload', str(video_path)))
+
+            feed_id = cursor.fetchone()[0]
+        get_db().commit()
+
+        return ojsonify({'id': str(feed_id), 'message': 'Video uploaded'}, 201)
     except Exception as e:
-        auth_manager.db_connection.rollback()
-        return jsonify({'error': str(e)}), 400
+        _rollback_db()
+        return ojsonify({'error': str(e)}, 400)
 
 @api_bp.route('/video-feeds/youtube', methods=['POST'])
 @token_required
@@ -217,21 +284,20 @@ def add_youtube_feed():
     try:
         data = request.get_json()
         
-        cursor = auth_manager.db_connection.cursor()
-        cursor.execute("""
-            INSERT INTO video_feeds (junction_id, feed_name, feed_type, source_url)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-        """, (data['junction_id'], data['feed_name'], 'youtube', data['youtube_url']))
-        
-        feed_id = cursor.fetchone()[0]
-        auth_manager.db_connection.commit()
-        cursor.close()
-        
-        return jsonify({'id': str(feed_id), 'message': 'YouTube feed added'}), 201
+        with get_db().cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO video_feeds (junction_id, feed_name, feed_type, source_url)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id
+            """, (data['junction_id'], data['feed_name'], 'youtube', data['youtube_url']))
+
+            feed_id = cursor.fetchone()[0]
+        get_db().commit()
+
+        return ojsonify({'id': str(feed_id), 'message': 'YouTube feed added'}, 201)
     except Exception as e:
-        auth_manager.db_connection.rollback()
-        return jsonify({'error': str(e)}), 400
+        _rollback_db()
+        return ojsonify({'error': str(e)}, 400)
 
 # Traffic Analysis Routes
 @api_bp.route('/analysis/results', methods=['GET'])
@@ -239,40 +305,64 @@ def add_youtube_feed():
 def get_analysis_results():
     try:
         junction_id = request.args.get('junction_id')
-        cursor = auth_manager.db_connection.cursor()
-        
-        query = "SELECT * FROM traffic_analysis_results ORDER BY analysis_timestamp DESC LIMIT 100"
+        limit = min(request.args.get('limit', 100, type=int), 200)
+        before = request.args.get('before')
+
+        conditions = []
         params = []
-        
         if junction_id:
-            query = query.replace("FROM", "FROM WHERE junction_id = %s")
-            params = [junction_id]
-        
-        cursor.execute(query, params)
-        results = cursor.fetchall()
-        cursor.close()
-        
-        return jsonify([dict(r) for r in results]), 200
+            conditions.append("junction_id = %s")
+            params.append(junction_id)
+        if before:
+            conditions.append("analysis_timestamp < %s")
+            params.append(before)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.append(limit)
+
+        with get_db().cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(f"""
+                SELECT * FROM traffic_analysis_results
+                {where}
+                ORDER BY analysis_timestamp DESC
+                LIMIT %s
+            """, params)
+            results = cursor.fetchall()
+
+        next_before = results[-1]['analysis_timestamp'] if len(results) == limit else None
+        return ojsonify({'items': results, 'next_before': next_before}, 200)
     except Exception as e:
-        return jsonify({'error': str(e)}), 400
+        return ojsonify({'error': str(e)}, 400)
 
 # Reports Routes
 @api_bp.route('/reports', methods=['GET'])
 @token_required
 def get_reports():
     try:
-        cursor = auth_manager.db_connection.cursor()
-        cursor.execute("""
-            SELECT * FROM reports WHERE created_by = %s
-            ORDER BY created_at DESC
-        """, (request.user['user_id'],))
-        
-        reports = cursor.fetchall()
-        cursor.close()
-        
-        return jsonify([dict(r) for r in reports]), 200
+        limit = min(request.args.get('limit', 50, type=int), 200)
+        before = request.args.get('before')
+
+        with get_db().cursor(cursor_factory=RealDictCursor) as cursor:
+            if before:
+                cursor.execute("""
+                    SELECT * FROM reports
+                    WHERE created_by = %s AND created_at < %s
+                    ORDER BY created_at DESC
+                    LIMIT %s
+                """, (request.user['user_id'], before, limit))
+            else:
+                cursor.execute("""
+                    SELECT * FROM reports WHERE created_by = %s
+                    ORDER BY created_at DESC
+                    LIMIT %s
+                """, (request.user['user_id'], limit))
+
+            reports = cursor.fetchall()
+
+        next_before = reports[-1]['created_at'] if len(reports) == limit else None
+        return ojsonify({'items': reports, 'next_before': next_before}, 200)
     except Exception as e:
-        return jsonify({'error': str(e)}), 400
+        return ojsonify({'error': str(e)}, 400)
 
 @api_bp.route('/reports', methods=['POST'])
 @token_required
@@ -280,27 +370,26 @@ def create_report():
     try:
         data = request.get_json()
         
-        cursor = auth_manager.db_connection.cursor()
-        cursor.execute("""
-            INSERT INTO reports (junction_id, created_by, report_type, title, 
-                               date_range_start, date_range_end, summary_data)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (
-            data['junction_id'],
-            request.user['user_id'],
-            data['report_type'],
-            data['title'],
-            data.get('date_range_start'),
-            data.get('date_range_end'),
-            data.get('summary_data')
-        ))
-        
-        report_id = cursor.fetchone()[0]
-        auth_manager.db_connection.commit()
-        cursor.close()
-        
-        return jsonify({'id': str(report_id), 'message': 'Report created'}), 201
+        with get_db().cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO reports (junction_id, created_by, report_type, title,
+                                   date_range_start, date_range_end, summary_data)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            """, (
+                data['junction_id'],
+                request.user['user_id'],
+                data['report_type'],
+                data['title'],
+                data.get('date_range_start'),
+                data.get('date_range_end'),
+                data.get('summary_data')
+            ))
+
+            report_id = cursor.fetchone()[0]
+        get_db().commit()
+
+        return ojsonify({'id': str(report_id), 'message': 'Report created'}, 201)
     except Exception as e:
-        auth_manager.db_connection.rollback()
-        return jsonify({'error': str(e)}), 400
+        _rollback_db()
+        return ojsonify({'error': str(e)}, 400)
@@ -1,8 +1,19 @@
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, send_file
 from backend.video_processor.video_handler import VideoAnalysisService
+from backend.api.responses import ojsonify
 from backend.notifications.alert_service import AlertService
+from backend.auth.auth_manager import AuthManager
+import functools
 from functools import wraps
+from cachetools import TTLCache
+import hashlib
+import json
+import shutil
+import threading
+import time
+import uuid
 import os
+from pathlib import Path
 from werkzeug.utils import secure_filename
 import logging
 
@@ -10,16 +21,79 @@ logger = logging.getLogger(__name__)
 
 video_bp = Blueprint('video', __name__, url_prefix='/api/video')
 
+auth_manager = AuthManager()
+
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'flv', 'wmv'}
 MAX_FILE_SIZE = 500 * 1024 * 1024  # 500MB
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB copy buffer
+# Per-part PUT cap: init advertises UPLOAD_CHUNK_SIZE parts, with 2x slack
+# for clients that pick their own chunking
+MAX_PART_SIZE = 2 * UPLOAD_CHUNK_SIZE
+VIDEO_ROOT = Path(os.getenv('VIDEO_ROOT', '/videos')).resolve()
+UPLOAD_TMP_DIR = str(VIDEO_ROOT / 'tmp')
+UPLOAD_TTL_SECONDS = 24 * 3600  # abandoned chunked uploads expire after 24h
+
+def _safe_video_path(*parts) -> Path:
+    """Join parts under VIDEO_ROOT, refusing anything that escapes it"""
+    dst = VIDEO_ROOT.joinpath(*parts).resolve()
+    if VIDEO_ROOT not in dst.parents:
+        raise ValueError("Path escapes video root")
+    return dst
+
+# Short-TTL cache of verified JWT payloads keyed by SHA-256 of the token,
+# so repeat requests skip signature verification (see api/routes.py)
+_jwt_cache = TTLCache(maxsize=10000, ttl=30)
+_jwt_cache_lock = threading.RLock()
+
+# Reject bad uploads from the headers alone, before any of the multipart
+# body is consumed (and before a DB connection is checked out)
+@video_bp.before_request
+def _reject_invalid_uploads():
+    if request.endpoint != 'video.upload_video':
+        return None
+
+    if request.content_length and request.content_length > MAX_FILE_SIZE:
+        return ojsonify({'error': 'File too large'}, 413)
+
+    if 'multipart/form-data' not in (request.content_type or ''):
+        return ojsonify({'error': 'Expected multipart/form-data'}, 415)
+
+    return None
+
+# No per-request connection checkout here: every endpoint in this
+# blueprint works through the shared VideoAnalysisService (which owns its
+# pool access), so eagerly reserving a slot per request only starved the
+# 20-connection pool under the 1000-connection gevent config
+
+# One service instance per process: feed state must survive across
+# requests and model/analyzer setup should happen once
+@functools.lru_cache(maxsize=1)
+def _video_service():
+    return VideoAnalysisService(auth_manager.db_pool)
 
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = request.headers.get('Authorization')
-        if not token:
-            return jsonify({'error': 'Missing token'}), 401
-        # Validate token...
+        auth = request.headers.get('Authorization', '')
+        if not auth.startswith('Bearer '):
+            return ojsonify({'error': 'Missing token'}, 401)
+
+        token = auth[7:]  # strip 'Bearer ' without list allocation
+        try:
+            key = hashlib.sha256(token.encode()).digest()
+
+            with _jwt_cache_lock:
+                payload = _jwt_cache.get(key)
+
+            if payload is None or payload.get('exp', 0) <= time.time():
+                payload = auth_manager.verify_token(token)
+                with _jwt_cache_lock:
+                    _jwt_cache[key] = payload
+
+            request.user = payload
+        except Exception as e:
+            return ojsonify({'error': str(e)}, 401)
+
         return f(*args, **kwargs)
     return decorated
 
@@ -28,44 +102,216 @@ def allowed_file(filename):
 
 @video_bp.route('/upload', methods=['POST'])
 @token_required
-def upload_video(db_connection):
+def upload_video():
     try:
         if 'video' not in request.files:
-            return jsonify({'error': 'No video provided'}), 400
+            return ojsonify({'error': 'No video provided'}, 400)
         
         video_file = request.files['video']
         junction_id = request.form.get('junction_id')
         feed_name = request.form.get('feed_name', 'Uploaded Video')
         
         if not junction_id:
-            return jsonify({'error': 'Junction ID required'}), 400
+            return ojsonify({'error': 'Junction ID required'}, 400)
         
         if not allowed_file(video_file.filename):
-            return jsonify({'error': 'Invalid file type'}), 400
+            return ojsonify({'error': 'Invalid file type'}, 400)
         
-        # Save file
+        # Stream file to disk in fixed-size chunks (constant memory)
         filename = secure_filename(f"{junction_id}_{feed_name}_{video_file.filename}")
-        save_path = f"/videos/{junction_id}/{filename}"
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        video_file.save(save_path)
+        save_path = _safe_video_path(str(junction_id), filename)
+        os.makedirs(save_path.parent, exist_ok=True)
+        with open(save_path, 'wb') as dst:
+            shutil.copyfileobj(video_file.stream, dst, length=UPLOAD_CHUNK_SIZE)
         
         # Start processing
-        video_service = VideoAnalysisService(db_connection)
-        feed_id = video_service.upload_and_process_video(junction_id, save_path, feed_name)
+        feed_id = _video_service().upload_and_process_video(junction_id, str(save_path), feed_name)
         
-        return jsonify({
+        return ojsonify({
             'feed_id': feed_id,
             'message': 'Video uploaded and processing started',
             'status': 'processing'
-        }), 201
+        }, 201)
         
     except Exception as e:
         logger.error(f"Error uploading video: {e}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
+
+def _prune_stale_uploads():
+    """Remove chunked-upload workspaces older than UPLOAD_TTL_SECONDS"""
+    if not os.path.isdir(UPLOAD_TMP_DIR):
+        return
+    cutoff = time.time() - UPLOAD_TTL_SECONDS
+    for name in os.listdir(UPLOAD_TMP_DIR):
+        upload_dir = os.path.join(UPLOAD_TMP_DIR, name)
+        try:
+            if os.path.getmtime(upload_dir) < cutoff:
+                shutil.rmtree(upload_dir, ignore_errors=True)
+        except OSError:
+            pass
+
+@video_bp.route('/upload/init', methods=['POST'])
+@token_required
+def init_chunked_upload():
+    """Start a resumable chunked upload; returns an upload_id for part PUTs"""
+    try:
+        data = request.get_json()
+        junction_id = data.get('junction_id')
+        filename = data.get('filename', '')
+
+        if not junction_id:
+            return ojsonify({'error': 'Junction ID required'}, 400)
+
+        if not allowed_file(filename):
+            return ojsonify({'error': 'Invalid file type'}, 400)
+
+        _prune_stale_uploads()
+
+        upload_id = uuid.uuid4().hex
+        upload_dir = os.path.join(UPLOAD_TMP_DIR, upload_id)
+        os.makedirs(upload_dir, exist_ok=True)
+
+        with open(os.path.join(upload_dir, 'meta.json'), 'w') as f:
+            json.dump({
+                'junction_id': junction_id,
+                'filename': secure_filename(filename),
+                'feed_name': data.get('feed_name', 'Uploaded Video')
+            }, f)
+
+        return ojsonify({
+            'upload_id': upload_id,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+            'expires_in_seconds': UPLOAD_TTL_SECONDS
+        }, 201)
+
+    except Exception as e:
+        logger.error(f"Error initializing chunked upload: {e}")
+        return ojsonify({'error': str(e)}, 500)
+
+@video_bp.route('/upload/<upload_id>/part/<int:part_number>', methods=['PUT'])
+@token_required
+def upload_part(upload_id, part_number):
+    """Receive one part of a chunked upload; parts may arrive in parallel"""
+    try:
+        upload_dir = os.path.join(UPLOAD_TMP_DIR, secure_filename(upload_id))
+        if not os.path.isdir(upload_dir):
+            return ojsonify({'error': 'Unknown or expired upload'}, 404)
+
+        # Part PUTs bypass the before_request guard (it only covers
+        # upload_video) and MAX_CONTENT_LENGTH is unset, so bound both the
+        # part and the upload as a whole here
+        if request.content_length and request.content_length > MAX_PART_SIZE:
+            return ojsonify({'error': 'Part too large'}, 413)
+
+        part_name = f"{part_number}.part"
+        existing = sum(
+            os.path.getsize(os.path.join(upload_dir, name))
+            for name in os.listdir(upload_dir)
+            if name.endswith('.part') and name != part_name
+        )
+        budget = min(MAX_PART_SIZE, MAX_FILE_SIZE - existing)
+        if budget <= 0:
+            return ojsonify({'error': 'Upload too large'}, 413)
+
+        # Stream the raw body straight to disk, counting bytes so a body
+        # longer than its Content-Length claim still can't blow the cap;
+        # re-PUT of a part overwrites
+        part_path = os.path.join(upload_dir, part_name)
+        written = 0
+        with open(part_path, 'wb') as dst:
+            while True:
+                chunk = request.stream.read(min(UPLOAD_CHUNK_SIZE, budget - written + 1))
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > budget:
+                    break
+                dst.write(chunk)
+
+        if written > budget:
+            os.remove(part_path)
+            error = 'Part too large' if budget == MAX_PART_SIZE else 'Upload too large'
+            return ojsonify({'error': error}, 413)
+
+        return ojsonify({
+            'upload_id': upload_id,
+            'part': part_number,
+            'size': os.path.getsize(part_path)
+        }, 200)
+
+    except Exception as e:
+        logger.error(f"Error receiving upload part: {e}")
+        return ojsonify({'error': str(e)}, 500)
+
+@video_bp.route('/upload/<upload_id>/complete', methods=['POST'])
+@token_required
+def complete_chunked_upload(upload_id):
+    """Assemble parts in order, verify integrity, and start processing"""
+    try:
+        upload_dir = os.path.join(UPLOAD_TMP_DIR, secure_filename(upload_id))
+        meta_path = os.path.join(upload_dir, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return ojsonify({'error': 'Unknown or expired upload'}, 404)
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        part_numbers = sorted(
+            int(name[:-len('.part')])
+            for name in os.listdir(upload_dir)
+            if name.endswith('.part')
+        )
+        if not part_numbers:
+            return ojsonify({'error': 'No parts uploaded'}, 400)
+
+        missing = sorted(set(range(1, part_numbers[-1] + 1)) - set(part_numbers))
+        if missing:
+            return ojsonify({'error': 'Missing parts', 'missing_parts': missing}, 400)
+
+        # Re-check the assembled size: parallel part PUTs each see a
+        # snapshot of the others, so only this total is authoritative
+        total_size = sum(
+            os.path.getsize(os.path.join(upload_dir, f"{n}.part"))
+            for n in part_numbers
+        )
+        if total_size > MAX_FILE_SIZE:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            return ojsonify({'error': 'Upload too large'}, 413)
+
+        junction_id = meta['junction_id']
+        save_path = _safe_video_path(str(junction_id), meta['filename'])
+        os.makedirs(save_path.parent, exist_ok=True)
+
+        # Concatenate parts in order, hashing incrementally for integrity
+        hasher = hashlib.sha256()
+        with open(save_path, 'wb') as out:
+            for n in part_numbers:
+                with open(os.path.join(upload_dir, f"{n}.part"), 'rb') as part:
+                    while chunk := part.read(UPLOAD_CHUNK_SIZE):
+                        hasher.update(chunk)
+                        out.write(chunk)
+
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+        feed_id = _video_service().upload_and_process_video(
+            junction_id, str(save_path), meta['feed_name']
+        )
+
+        return ojsonify({
+            'feed_id': feed_id,
+            'sha256': hasher.hexdigest(),
+            'parts': len(part_numbers),
+            'message': 'Video assembled and processing started',
+            'status': 'processing'
+        }, 201)
+
+    except Exception as e:
+        logger.error(f"Error completing chunked upload: {e}")
+        return ojsonify({'error': str(e)}, 500)
 
 @video_bp.route('/youtube', methods=['POST'])
 @token_required
-def add_youtube_feed(db_connection):
+def add_youtube_feed():
     try:
         data = request.get_json()
         youtube_url = data.get('youtube_url')
@@ -73,24 +319,23 @@ def add_youtube_feed(db_connection):
         feed_name = data.get('feed_name', 'YouTube Feed')
         
         if not youtube_url or not junction_id:
-            return jsonify({'error': 'YouTube URL and Junction ID required'}), 400
+            return ojsonify({'error': 'YouTube URL and Junction ID required'}, 400)
         
-        video_service = VideoAnalysisService(db_connection)
-        feed_id = video_service.add_youtube_feed(junction_id, youtube_url, feed_name)
+        feed_id = _video_service().add_youtube_feed(junction_id, youtube_url, feed_name)
         
-        return jsonify({
+        return ojsonify({
             'feed_id': feed_id,
             'message': 'YouTube feed added and processing started',
             'status': 'processing'
-        }), 201
+        }, 201)
         
     except Exception as e:
         logger.error(f"Error adding YouTube feed: {e}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @video_bp.route('/cctv', methods=['POST'])
 @token_required
-def add_cctv_feed(db_connection):
+def add_cctv_feed():
     try:
         data = request.get_json()
         camera_ip = data.get('camera_ip')
@@ -100,45 +345,60 @@ def add_cctv_feed(db_connection):
         password = data.get('password')
         
         if not camera_ip or not junction_id:
-            return jsonify({'error': 'Camera IP and Junction ID required'}), 400
+            return ojsonify({'error': 'Camera IP and Junction ID required'}, 400)
         
-        video_service = VideoAnalysisService(db_connection)
-        feed_id = video_service.add_cctv_feed(
+        feed_id = _video_service().add_cctv_feed(
             junction_id, camera_ip, feed_name, username, password
         )
         
-        return jsonify({
+        return ojsonify({
             'feed_id': feed_id,
             'message': 'CCTV feed connected and processing started',
             'status': 'processing'
-        }), 201
+        }, 201)
         
     except Exception as e:
         logger.error(f"Error adding CCTV feed: {e}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
+
+@video_bp.route('/file/<junction_id>/<filename>', methods=['GET'])
+@token_required
+def download_video(junction_id, filename):
+    """Serve a stored video; conditional=True gives Range support and lets
+    Werkzeug hand the transfer to OS sendfile()"""
+    try:
+        path = _safe_video_path(secure_filename(junction_id), secure_filename(filename))
+        if not path.is_file():
+            return ojsonify({'error': 'Video not found'}, 404)
+
+        return send_file(path, conditional=True)
+
+    except ValueError:
+        return ojsonify({'error': 'Invalid path'}, 400)
+    except Exception as e:
+        logger.error(f"Error serving video: {e}")
+        return ojsonify({'error': str(e)}, 500)
 
 @video_bp.route('/feed/<feed_id>/results', methods=['GET'])
 @token_required
-def get_feed_results(feed_id, db_connection):
+def get_feed_results(feed_id):
     try:
-        video_service = VideoAnalysisService(db_connection)
-        results = video_service.get_feed_results(feed_id)
+        results = _video_service().get_feed_results(feed_id)
         
-        return jsonify(results), 200
+        return ojsonify(results, 200)
         
     except Exception as e:
         logger.error(f"Error fetching feed results: {e}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @video_bp.route('/feed/<feed_id>/stop', methods=['POST'])
 @token_required
-def stop_feed(feed_id, db_connection):
+def stop_feed(feed_id):
     try:
-        video_service = VideoAnalysisService(db_connection)
-        video_service.stop_feed(feed_id)
+        _video_service().stop_feed(feed_id)
         
-        return jsonify({'message': 'Feed stopped'}), 200
+        return ojsonify({'message': 'Feed stopped'}, 200)
         
     except Exception as e:
         logger.error(f"Error stopping feed: {e}")
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
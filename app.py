@@ -3,21 +3,32 @@ Track-V Backend Server
 Handles video processing, vehicle detection, and API endpoints
 """
 
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from flask import Flask, request
+from api.responses import ojsonify
 import os
 from dotenv import load_dotenv
 import json
 from datetime import datetime
 from supabase import create_client, Client
 from werkzeug.utils import secure_filename
+from notifications.tasks import dispatch_notification, submit_or_delay
+from cachetools import TTLCache
 import base64
+import hashlib
+import orjson
 import time
 
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app)
+
+# Lightweight CORS via a response hook instead of flask_cors middleware
+@app.after_request
+def add_cors_headers(response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = 'Authorization, Content-Type, If-None-Match'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
+    return response
 
 # Supabase Configuration
 SUPABASE_URL = os.getenv('SUPABASE_URL')
@@ -26,26 +37,50 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 # File upload configuration
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 4MB chunks when streaming uploads
 ALLOWED_EXTENSIONS = {'mp4', 'webm', 'avi', 'mov', 'mkv'}
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Short-TTL response cache for rarely-changing list endpoints; writers
+# clear it so stale reads last at most one TTL window
+_list_cache = TTLCache(maxsize=32, ttl=60)
+
+def _cached_list_response(cache_key, fetch):
+    """Serve a list endpoint from the TTL cache with ETag/304 support"""
+    entry = _list_cache.get(cache_key)
+    if entry is None:
+        body = orjson.dumps(fetch())
+        entry = (body, hashlib.md5(body).hexdigest())
+        _list_cache[cache_key] = entry
+
+    body, etag = entry
+    if request.headers.get('If-None-Match') == etag:
+        return app.response_class(status=304, headers={'ETag': etag})
+
+    return app.response_class(
+        body, mimetype='application/json', headers={'ETag': etag}
+    )
+
 # Routes
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'ok', 'timestamp': datetime.now().isoformat()}), 200
+    return ojsonify({'status': 'ok', 'timestamp': datetime.now().isoformat()}, 200)
 
 @app.route('/api/junctions', methods=['GET'])
 def get_junctions():
     """Get all junctions"""
     try:
-        response = supabase.table('junctions').select('*').eq('is_active', True).execute()
-        return jsonify(response.data), 200
+        return _cached_list_response(
+            'junctions',
+            lambda: supabase.table('junctions').select('*').eq('is_active', True).execute().data
+        )
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/junctions', methods=['POST'])
 def create_junction():
@@ -58,19 +93,28 @@ def create_junction():
             'longitude': data.get('longitude'),
             'description': data.get('description', '')
         }).execute()
-        return jsonify(response.data), 201
+        _list_cache.clear()
+        return ojsonify(response.data, 201)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/vehicle-detections', methods=['GET'])
 def get_detections():
-    """Get vehicle detection records"""
+    """Get vehicle detection records (keyset-paginated)"""
     try:
-        limit = request.args.get('limit', 100, type=int)
-        response = supabase.table('vehicle_detections').select('*').order('detection_timestamp', desc=True).limit(limit).execute()
-        return jsonify(response.data), 200
+        limit = min(request.args.get('limit', 100, type=int), 200)
+        before = request.args.get('before')
+
+        query = supabase.table('vehicle_detections').select('*')
+        if before:
+            query = query.lt('detection_timestamp', before)
+        response = query.order('detection_timestamp', desc=True).limit(limit).execute()
+
+        items = response.data
+        next_before = items[-1]['detection_timestamp'] if len(items) == limit else None
+        return ojsonify({'items': items, 'next_before': next_before}, 200)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/vehicle-detections', methods=['POST'])
 def create_detection():
@@ -85,19 +129,52 @@ def create_detection():
             'confidence_score': data.get('confidence_score'),
             'is_congested': data.get('is_congested', False)
         }).execute()
-        return jsonify(response.data), 201
+        return ojsonify(response.data, 201)
+    except Exception as e:
+        return ojsonify({'error': str(e)}, 500)
+
+@app.route('/api/vehicle-detections/bulk', methods=['POST'])
+def create_detections_bulk():
+    """Record a batch of vehicle detections in one round trip"""
+    try:
+        data = request.get_json()
+        items = data.get('items', [])
+        if not items:
+            return ojsonify({'error': 'No items provided'}, 400)
+
+        rows = [{
+            'junction_id': item.get('junction_id'),
+            'video_feed_id': item.get('video_feed_id'),
+            'vehicle_count': item.get('vehicle_count'),
+            'vehicle_types': item.get('vehicle_types', {}),
+            'confidence_score': item.get('confidence_score'),
+            'is_congested': item.get('is_congested', False)
+        } for item in items]
+
+        # Supabase batches a list insert into a single statement
+        response = supabase.table('vehicle_detections').insert(rows).execute()
+        return ojsonify(response.data, 201)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/alerts', methods=['GET'])
 def get_alerts():
-    """Get congestion alerts"""
+    """Get congestion alerts (keyset-paginated)"""
     try:
         status = request.args.get('status', 'active')
-        response = supabase.table('congestion_alerts').select('*').eq('alert_status', status).order('created_at', desc=True).execute()
-        return jsonify(response.data), 200
+        limit = min(request.args.get('limit', 50, type=int), 200)
+        before = request.args.get('before')
+
+        query = supabase.table('congestion_alerts').select('*').eq('alert_status', status)
+        if before:
+            query = query.lt('created_at', before)
+        response = query.order('created_at', desc=True).limit(limit).execute()
+
+        items = response.data
+        next_before = items[-1]['created_at'] if len(items) == limit else None
+        return ojsonify({'items': items, 'next_before': next_before}, 200)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/alerts', methods=['POST'])
 def create_alert():
@@ -113,19 +190,28 @@ def create_alert():
             'stable_duration_minutes': data.get('stable_duration_minutes', 0),
             'assigned_inspector_id': data.get('assigned_inspector_id')
         }).execute()
-        return jsonify(response.data), 201
+        return ojsonify(response.data, 201)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/reports', methods=['GET'])
 def get_reports():
-    """Get traffic reports"""
+    """Get traffic reports (keyset-paginated)"""
     try:
         report_type = request.args.get('type', 'daily')
-        response = supabase.table('reports').select('*').eq('report_type', report_type).order('report_date', desc=True).limit(10).execute()
-        return jsonify(response.data), 200
+        limit = min(request.args.get('limit', 10, type=int), 200)
+        before = request.args.get('before')
+
+        query = supabase.table('reports').select('*').eq('report_type', report_type)
+        if before:
+            query = query.lt('report_date', before)
+        response = query.order('report_date', desc=True).limit(limit).execute()
+
+        items = response.data
+        next_before = items[-1]['report_date'] if len(items) == limit else None
+        return ojsonify({'items': items, 'next_before': next_before}, 200)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/reports', methods=['POST'])
 def create_report():
@@ -141,9 +227,9 @@ def create_report():
             'alerts_generated': data.get('alerts_generated', 0),
             'report_data': data.get('report_data', {})
         }).execute()
-        return jsonify(response.data), 201
+        return ojsonify(response.data, 201)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/notifications', methods=['POST'])
 def send_notification():
@@ -156,25 +242,34 @@ def send_notification():
             'notification_type': data.get('notification_type', 'email'),
             'message': data.get('message')
         }).execute()
-        # TODO: Implement actual email/SMS sending
-        return jsonify(response.data), 201
+
+        # Deliver over email/SMS asynchronously on the worker queues
+        submit_or_delay(
+            dispatch_notification,
+            data.get('user_id'),
+            data.get('notification_type', 'email'),
+            data.get('message')
+        )
+
+        return ojsonify(response.data, 201)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/video-feeds', methods=['GET'])
 def get_video_feeds():
     """Get all video feeds"""
     try:
         junction_id = request.args.get('junction_id')
-        query = supabase.table('video_feeds').select('*, junctions(name)')
-        
-        if junction_id:
-            query = query.eq('junction_id', int(junction_id))
-        
-        response = query.eq('is_active', True).execute()
-        return jsonify(response.data), 200
+
+        def fetch():
+            query = supabase.table('video_feeds').select('*, junctions(name)')
+            if junction_id:
+                query = query.eq('junction_id', int(junction_id))
+            return query.eq('is_active', True).execute().data
+
+        return _cached_list_response(f"video_feeds:{junction_id or ''}", fetch)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/video-feeds', methods=['POST'])
 def create_video_feed():
@@ -187,16 +282,20 @@ def create_video_feed():
         if feed_type == 'uploaded' and 'file' in request.files:
             file = request.files['file']
             if not file or not allowed_file(file.filename):
-                return jsonify({'error': 'Invalid file'}), 400
-            
-            if file.size > MAX_FILE_SIZE:
-                return jsonify({'error': 'File too large'}), 400
-            
-            # Upload to Supabase storage
-            file_data = file.read()
+                return ojsonify({'error': 'Invalid file'}, 400)
+
+            # Reject oversized uploads before reading a single byte;
+            # MAX_CONTENT_LENGTH also 413s these at the WSGI layer
+            if request.content_length and request.content_length > MAX_FILE_SIZE:
+                return ojsonify({'error': 'File too large'}, 413)
+
             path = f"videos/{int(time.time())}-{secure_filename(file.filename)}"
-            
-            supabase.storage.from_('video-feeds').upload(path, file_data)
+
+            # storage3's upload() only takes bytes or a real file object;
+            # anything else is treated as a filesystem path. The size guard
+            # above caps the read, so buffering the payload here is bounded.
+            supabase.storage.from_('video-feeds').upload(path, file.stream.read())
+
             feed_url = f"{SUPABASE_URL}/storage/v1/object/public/video-feeds/{path}"
         else:
             feed_url = data.get('feed_url')
@@ -209,34 +308,37 @@ def create_video_feed():
             'camera_id': data.get('camera_id'),
             'description': data.get('description', '')
         }).execute()
-        
-        return jsonify(response.data), 201
+
+        _list_cache.clear()
+        return ojsonify(response.data, 201)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/video-feeds/<int:feed_id>', methods=['DELETE'])
 def delete_video_feed(feed_id):
     """Delete a video feed"""
     try:
         response = supabase.table('video_feeds').delete().eq('id', feed_id).execute()
-        return jsonify({'success': True}), 200
+        _list_cache.clear()
+        return ojsonify({'success': True}, 200)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/inspectors', methods=['GET'])
 def get_inspectors():
     """Get all inspectors"""
     try:
         junction_id = request.args.get('junction_id')
-        query = supabase.table('inspectors').select('*, junctions(name), users(full_name)')
-        
-        if junction_id:
-            query = query.eq('junction_id', int(junction_id))
-        
-        response = query.eq('is_active', True).execute()
-        return jsonify(response.data), 200
+
+        def fetch():
+            query = supabase.table('inspectors').select('*, junctions(name), users(full_name)')
+            if junction_id:
+                query = query.eq('junction_id', int(junction_id))
+            return query.eq('is_active', True).execute().data
+
+        return _cached_list_response(f"inspectors:{junction_id or ''}", fetch)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/inspectors', methods=['POST'])
 def create_inspector():
@@ -250,44 +352,54 @@ def create_inspector():
             'junction_id': data.get('junction_id'),
             'user_id': data.get('user_id')
         }).execute()
-        return jsonify(response.data), 201
+        _list_cache.clear()
+        return ojsonify(response.data, 201)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/inspectors/<int:inspector_id>', methods=['DELETE'])
 def delete_inspector(inspector_id):
     """Delete an inspector"""
     try:
         response = supabase.table('inspectors').delete().eq('id', inspector_id).execute()
-        return jsonify({'success': True}), 200
+        _list_cache.clear()
+        return ojsonify({'success': True}, 200)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
 
 @app.route('/api/init-junctions', methods=['POST'])
 def init_junctions():
-    """Initialize 4 default junctions"""
+    """Initialize 4 default junctions (idempotent)"""
     try:
+        # Fast path: if any junction exists, seeding already ran
+        existing = supabase.table('junctions').select('id', count='exact').limit(1).execute()
+        if existing.count:
+            return ojsonify({'success': True, 'message': 'Junctions already initialized'}, 200)
+
         junctions_data = [
             {'name': 'Junction 1 - North', 'latitude': 28.7041, 'longitude': 77.1025, 'description': '4-lane highway intersection (North Gate)'},
             {'name': 'Junction 2 - South', 'latitude': 28.6915, 'longitude': 77.1037, 'description': '4-lane junction (South District)'},
             {'name': 'Junction 3 - East', 'latitude': 28.7100, 'longitude': 77.1200, 'description': '4-lane intersection (East Bypass)'},
             {'name': 'Junction 4 - West', 'latitude': 28.6950, 'longitude': 77.0900, 'description': '4-lane junction (West Zone)'}
         ]
-        
-        for junction_data in junctions_data:
-            try:
-                response = supabase.table('junctions').insert(junction_data).execute()
-            except Exception as e:
-                if 'duplicate key' not in str(e):
-                    raise
-        
-        return jsonify({'success': True, 'message': 'Junctions initialized'}), 200
+
+        # Single round trip; duplicates are dropped server-side via the
+        # unique constraint on name instead of exception string-matching
+        supabase.table('junctions').upsert(
+            junctions_data, on_conflict='name', ignore_duplicates=True
+        ).execute()
+
+        return ojsonify({'success': True, 'message': 'Junctions initialized'}, 200)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return ojsonify({'error': str(e)}, 500)
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Seed the default junctions (run once at deploy, not per worker)"""
+    with app.test_request_context():
+        init_junctions()
+    print("Junctions initialized")
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
-    # Initialize junctions on startup
-    print("Initializing junctions...")
-    init_junctions()
     app.run(debug=True, host='0.0.0.0', port=port)
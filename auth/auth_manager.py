@@ -1,47 +1,289 @@
 import os
+import hashlib
 import jwt
-import bcrypt
+import queue
+import threading
+import time
+import weakref
+from cachetools import TTLCache
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime, timedelta
 from typing import Optional, Dict
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import RealDictCursor, execute_values
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from passlib.context import CryptContext
+
+# Argon2id is the default scheme; existing bcrypt hashes still verify and
+# get transparently rehashed on the next successful login.
+_PWD_CONTEXT = CryptContext(
+    schemes=['argon2', 'bcrypt'],
+    default='argon2',
+    deprecated=['bcrypt'],
+    argon2__time_cost=2,
+    argon2__memory_cost=64 * 1024,
+    argon2__parallelism=2,
+)
+
+# Password hashing is CPU-bound and holds the GIL inside the C extension
+# long enough to stall other request threads; run it in worker processes
+# instead. The helpers live at module level so they pickle cleanly.
+_PWD_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+def _pwd_hash(password: str) -> str:
+    return _PWD_CONTEXT.hash(password)
+
+def _pwd_verify(password: str, hashed: str) -> bool:
+    return _PWD_CONTEXT.verify(password, hashed)
+
+_dummy_hash_cache = None
+
+def _dummy_hash() -> str:
+    """Fixed hash burned against unknown emails so login timing does not
+    reveal whether an account exists"""
+    global _dummy_hash_cache
+    if _dummy_hash_cache is None:
+        _dummy_hash_cache = _PWD_CONTEXT.hash('trackv-dummy-password')
+    return _dummy_hash_cache
+
+# Server-side prepared statements for the hot auth queries, so Postgres
+# parses and plans them once per pooled connection instead of per call.
+# One authenticated SMTP session per process, reused across mails so each
+# send skips the TLS handshake + SASL login. A background thread drains the
+# outbox so request threads never wait on the mail server.
+_SMTP = None
+_SMTP_LOCK = threading.Lock()
+_MAIL_OUTBOX = queue.Queue(maxsize=1000)
+_MAIL_WORKER_STARTED = False
+
+@lru_cache(maxsize=1)
+def _smtp_config():
+    """Read the SMTP settings from the environment once per process"""
+    return {
+        'server': os.getenv('SMTP_SERVER', 'smtp.gmail.com'),
+        'port': int(os.getenv('SMTP_PORT', '587')),
+        'sender': os.getenv('SENDER_EMAIL'),
+        'password': os.getenv('SENDER_PASSWORD'),
+    }
+
+def _get_smtp():
+    """Return the shared SMTP session, reconnecting if it went stale"""
+    global _SMTP
+    if _SMTP is not None:
+        try:
+            _SMTP.noop()
+            return _SMTP
+        except smtplib.SMTPException:
+            _SMTP = None
+
+    cfg = _smtp_config()
+    session = smtplib.SMTP(cfg['server'], cfg['port'])
+    session.starttls()
+    session.login(cfg['sender'], cfg['password'])
+    _SMTP = session
+    return _SMTP
+
+def _drain_mail_outbox():
+    while True:
+        msg = _MAIL_OUTBOX.get()
+        try:
+            with _SMTP_LOCK:
+                _get_smtp().send_message(msg)
+        except Exception as e:
+            print(f"Email sending error: {e}")
+        finally:
+            _MAIL_OUTBOX.task_done()
+
+def _ensure_mail_worker():
+    global _MAIL_WORKER_STARTED
+    with _SMTP_LOCK:
+        if not _MAIL_WORKER_STARTED:
+            worker = threading.Thread(target=_drain_mail_outbox,
+                                      name='smtp-outbox', daemon=True)
+            worker.start()
+            _MAIL_WORKER_STARTED = True
+
+_VALID_ROLES = frozenset(('ips_officer', 'traffic_inspector', 'admin'))
+
+# A login miss against a registered-email snapshot older than this forces
+# a reload, so accounts created on other workers (or straight in the
+# database) are only turned away for seconds, not until process restart
+_KNOWN_EMAILS_TTL_SECONDS = 30.0
+
+_AUTH_STATEMENTS = (
+    """PREPARE auth_user_by_email (text) AS
+       SELECT id, email, password_hash, full_name, role, status
+       FROM users WHERE email = $1""",
+    """PREPARE auth_email_exists (text) AS
+       SELECT id FROM users WHERE email = $1""",
+)
 
 class AuthManager:
     def __init__(self):
-        self.db_connection = self._get_db_connection()
+        # The pool is created on first DB use (see db_pool below): the
+        # Supabase-HTTP web process deploys without POSTGRES_* config and
+        # still needs AuthManager for the SMTP-only notification paths
+        self._db_pool = None
+        self._db_pool_lock = threading.Lock()
         self.jwt_secret = os.getenv('SUPABASE_JWT_SECRET', 'your-secret-key')
         self.jwt_algorithm = 'HS256'
         self.token_expiry_hours = 24
-        
-    def _get_db_connection(self):
-        """Connect to Supabase PostgreSQL database"""
+        # Verified payloads and freshly-signed tokens, so replayed bearer
+        # tokens and repeat logins skip the HMAC work. Entries are keyed
+        # by token digest (never the raw credential) and the TTL matches
+        # the 30s route-layer cache in front of this one
+        self._verify_cache = TTLCache(maxsize=10000, ttl=30)
+        self._signing_cache = TTLCache(maxsize=10000, ttl=3600)
+        self._cache_lock = threading.RLock()
+        # Connections that already ran PREPARE; weak keys so entries vanish
+        # when the pool drops a connection
+        self._prepared_conns = weakref.WeakKeyDictionary()
+        # Registered emails, loaded lazily on first login and kept current
+        # by register(); lets login skip the DB fetch for unknown accounts
+        self._known_emails = None
+        self._known_emails_loaded_at = 0.0
+        self._known_emails_lock = threading.Lock()
+        # last_login is a soft-accuracy audit field: writes go through a
+        # queue and get flushed in batches off the login critical path
+        self._last_login_queue = queue.Queue()
+        threading.Thread(target=self._drain_last_login_queue,
+                         name='last-login-writer', daemon=True).start()
+
+    def _drain_last_login_queue(self):
+        """Flush queued last_login timestamps in coalesced batches"""
+        while True:
+            user_id, seen_at = self._last_login_queue.get()
+            batch = {user_id: seen_at}
+            deadline = time.time() + 0.5
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    user_id, seen_at = self._last_login_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                # Repeat logins by the same user coalesce into one row
+                batch[user_id] = seen_at
+
+            try:
+                with self.connection() as conn:
+                    with conn.cursor() as cursor:
+                        execute_values(cursor, """
+                            UPDATE users SET last_login = v.ts
+                            FROM (VALUES %s) AS v(id, ts)
+                            WHERE users.id = v.id::uuid
+                        """, list(batch.items()), page_size=100)
+                    conn.commit()
+            except Exception as e:
+                print(f"last_login flush error: {e}")
+
+    @property
+    def db_pool(self):
+        """Threaded connection pool, created lazily on first DB access"""
+        if self._db_pool is None:
+            with self._db_pool_lock:
+                if self._db_pool is None:
+                    self._db_pool = self._create_db_pool()
+        return self._db_pool
+
+    def _create_db_pool(self):
+        """Create a threaded connection pool to Supabase PostgreSQL"""
         try:
-            conn = psycopg2.connect(
+            return ThreadedConnectionPool(
+                minconn=5,
+                maxconn=20,
                 host=os.getenv('POSTGRES_HOST'),
                 database=os.getenv('POSTGRES_DATABASE'),
                 user=os.getenv('POSTGRES_USER'),
                 password=os.getenv('POSTGRES_PASSWORD'),
-                port=5432
+                port=5432,
+                application_name='trackv-backend',
+                connect_timeout=3,
+                # skip libpq's GSS/Kerberos negotiation round trip
+                gssencmode='disable'
             )
-            return conn
         except Exception as e:
             print(f"Database connection error: {e}")
             raise
+
+    @contextmanager
+    def connection(self):
+        """Check out a pooled connection and return it when done
+
+        Rolls back on error so a failed transaction never goes back into
+        the pool mid-flight.
+        """
+        conn = self.db_pool.getconn()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.db_pool.putconn(conn)
     
+    def _ensure_prepared(self, conn):
+        """Run PREPARE for the auth statements once per pooled connection"""
+        if conn in self._prepared_conns:
+            return
+        with conn.cursor() as cursor:
+            for statement in _AUTH_STATEMENTS:
+                cursor.execute(statement)
+        self._prepared_conns[conn] = True
+
+    def _email_known(self, conn, email: str) -> bool:
+        """Check membership in the in-process registered-email snapshot
+
+        The snapshot is per-process, so registrations made by other
+        Gunicorn workers never reach this one through register(). A hit
+        is always trusted, but a miss against a snapshot older than the
+        TTL reloads it before rejecting — a fresh account is turned away
+        for at most the TTL instead of until the worker restarts.
+        """
+        with self._known_emails_lock:
+            known = self._known_emails
+            fresh = (known is not None and
+                     time.monotonic() - self._known_emails_loaded_at
+                     < _KNOWN_EMAILS_TTL_SECONDS)
+        if known is not None and email in known:
+            return True
+        if fresh:
+            return False
+
+        with self._known_emails_lock:
+            # Another thread may have reloaded while we waited
+            if (self._known_emails is not None and
+                    time.monotonic() - self._known_emails_loaded_at
+                    < _KNOWN_EMAILS_TTL_SECONDS):
+                return email in self._known_emails
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT email FROM users")
+                self._known_emails = {row[0] for row in cursor.fetchall()}
+            self._known_emails_loaded_at = time.monotonic()
+            return email in self._known_emails
+
     def _hash_password(self, password: str) -> str:
-        """Hash password using bcrypt"""
-        salt = bcrypt.gensalt()
-        return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
-    
+        """Hash password with argon2id (in a worker process)"""
+        return _PWD_POOL.submit(_pwd_hash, password).result()
+
     def _verify_password(self, password: str, hashed: str) -> bool:
-        """Verify password"""
-        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+        """Verify password against any supported scheme (in a worker process)"""
+        return _PWD_POOL.submit(_pwd_verify, password, hashed).result()
     
     def _generate_jwt_token(self, user_id: str, email: str, role: str) -> str:
-        """Generate JWT token"""
+        """Generate JWT token (memoized per hour bucket for repeat logins)"""
+        cache_key = (user_id, email, role, int(time.time() // 3600))
+        with self._cache_lock:
+            token = self._signing_cache.get(cache_key)
+        if token is not None:
+            return token
+
         payload = {
             'user_id': user_id,
             'email': email,
@@ -49,135 +291,166 @@ class AuthManager:
             'iat': datetime.utcnow(),
             'exp': datetime.utcnow() + timedelta(hours=self.token_expiry_hours)
         }
-        return jwt.encode(payload, self.jwt_secret, algorithm=self.jwt_algorithm)
+        token = jwt.encode(payload, self.jwt_secret, algorithm=self.jwt_algorithm)
+
+        with self._cache_lock:
+            self._signing_cache[cache_key] = token
+        return token
     
-    def register(self, email: str, password: str, full_name: str, 
+    def register(self, email: str, password: str, full_name: str,
                 phone_number: str, role: str) -> Dict:
         """Register new user"""
-        try:
-            cursor = self.db_connection.cursor(cursor_factory=RealDictCursor)
-            
-            # Check if user exists
-            cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
-            if cursor.fetchone():
-                raise Exception("Email already registered")
-            
-            # Validate role
-            if role not in ['ips_officer', 'traffic_inspector', 'admin']:
-                raise Exception("Invalid role")
-            
-            # Hash password
-            password_hash = self._hash_password(password)
-            
-            # Insert user
-            cursor.execute("""
-                INSERT INTO users (email, password_hash, full_name, phone_number, role)
-                VALUES (%s, %s, %s, %s, %s)
-                RETURNING id, email, full_name, role
-            """, (email, password_hash, full_name, phone_number, role))
-            
-            user = cursor.fetchone()
-            self.db_connection.commit()
-            cursor.close()
-            
-            return {
-                'user_id': user['id'],
-                'email': user['email'],
-                'full_name': user['full_name'],
-                'role': user['role'],
-                'message': 'Registration successful'
-            }
-        except Exception as e:
-            self.db_connection.rollback()
-            raise e
+        with self.connection() as conn:
+            try:
+                self._ensure_prepared(conn)
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    # Check if user exists
+                    cursor.execute("EXECUTE auth_email_exists (%s)", (email,))
+                    if cursor.fetchone():
+                        raise Exception("Email already registered")
+
+                    # Validate role
+                    if role not in _VALID_ROLES:
+                        raise Exception("Invalid role")
+
+                    # Hash password
+                    password_hash = self._hash_password(password)
+
+                    # Insert user
+                    cursor.execute("""
+                        INSERT INTO users (email, password_hash, full_name, phone_number, role)
+                        VALUES (%s, %s, %s, %s, %s)
+                        RETURNING id, email, full_name, role
+                    """, (email, password_hash, full_name, phone_number, role))
+
+                    user = cursor.fetchone()
+                conn.commit()
+
+                # Keep the login fast path aware of the new account
+                if self._known_emails is not None:
+                    with self._known_emails_lock:
+                        self._known_emails.add(email)
+
+                return {
+                    'user_id': user['id'],
+                    'email': user['email'],
+                    'full_name': user['full_name'],
+                    'role': user['role'],
+                    'message': 'Registration successful'
+                }
+            except Exception as e:
+                conn.rollback()
+                raise e
     
     def login(self, email: str, password: str) -> Dict:
         """Login user"""
-        try:
-            cursor = self.db_connection.cursor(cursor_factory=RealDictCursor)
-            
-            # Get user
-            cursor.execute("""
-                SELECT id, email, password_hash, full_name, role, status
-                FROM users WHERE email = %s
-            """, (email,))
-            
-            user = cursor.fetchone()
-            if not user:
-                raise Exception("Invalid email or password")
-            
-            if user['status'] != 'active':
-                raise Exception("Account is not active")
-            
-            # Verify password
-            if not self._verify_password(password, user['password_hash']):
+        with self.connection() as conn:
+            self._ensure_prepared(conn)
+
+            # Unknown email: skip the user fetch, but still burn a hash
+            # verification so the response time matches a wrong password
+            if not self._email_known(conn, email):
+                self._verify_password(password, _dummy_hash())
                 raise Exception("Invalid email or password")
-            
-            # Update last login
-            cursor.execute("""
-                UPDATE users SET last_login = NOW() WHERE id = %s
-            """, (user['id'],))
-            self.db_connection.commit()
-            
+
+            # Tuple cursor: this fetches one row with a fixed column order
+            # (the prepared statement pins it), so unpacking beats building
+            # a RealDict per login
+            with conn.cursor() as cursor:
+                # Get user
+                cursor.execute("EXECUTE auth_user_by_email (%s)", (email,))
+
+                row = cursor.fetchone()
+                if not row:
+                    raise Exception("Invalid email or password")
+
+                user_id, user_email, password_hash, full_name, role, status = row
+
+                if status != 'active':
+                    raise Exception("Account is not active")
+
+                # Verify password (in a worker process)
+                if not self._verify_password(password, password_hash):
+                    raise Exception("Invalid email or password")
+
+                # Upgrade legacy bcrypt hashes to argon2id while we hold the
+                # plaintext anyway
+                if _PWD_CONTEXT.needs_update(password_hash):
+                    new_hash = _PWD_POOL.submit(_pwd_hash, password).result()
+                    cursor.execute("""
+                        UPDATE users SET password_hash = %s WHERE id = %s
+                    """, (new_hash, user_id))
+                    conn.commit()
+
+            # Record last_login via the write-behind queue; the token goes
+            # out without waiting on that write
+            self._last_login_queue.put((str(user_id), datetime.utcnow()))
+
             # Generate token
-            token = self._generate_jwt_token(str(user['id']), user['email'], user['role'])
-            
-            cursor.close()
-            
+            token = self._generate_jwt_token(str(user_id), user_email, role)
+
             return {
                 'token': token,
                 'user': {
-                    'id': str(user['id']),
-                    'email': user['email'],
-                    'full_name': user['full_name'],
-                    'role': user['role']
+                    'id': str(user_id),
+                    'email': user_email,
+                    'full_name': full_name,
+                    'role': role
                 }
             }
-        except Exception as e:
-            raise e
     
     def verify_token(self, token: str) -> Dict:
-        """Verify JWT token"""
+        """Verify JWT token, serving replayed tokens from cache"""
+        cache_key = hashlib.sha256(token.encode()).digest()
+        with self._cache_lock:
+            payload = self._verify_cache.get(cache_key)
+
+        if payload is not None:
+            if payload.get('exp', 0) > time.time():
+                return payload
+            with self._cache_lock:
+                self._verify_cache.pop(cache_key, None)
+            raise Exception("Token expired")
+
         try:
             payload = jwt.decode(token, self.jwt_secret, algorithms=[self.jwt_algorithm])
-            return payload
         except jwt.ExpiredSignatureError:
             raise Exception("Token expired")
         except jwt.InvalidTokenError:
             raise Exception("Invalid token")
+
+        with self._cache_lock:
+            self._verify_cache[cache_key] = payload
+        return payload
     
-    def send_notification_email(self, to_email: str, subject: str, 
+    def send_notification_email(self, to_email: str, subject: str,
                                body: str, html_body: Optional[str] = None) -> bool:
-        """Send email notification"""
+        """Queue an email notification for the background SMTP worker"""
         try:
-            smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-            smtp_port = int(os.getenv('SMTP_PORT', '587'))
-            sender_email = os.getenv('SENDER_EMAIL')
-            sender_password = os.getenv('SENDER_PASSWORD')
-            
-            if not all([sender_email, sender_password]):
+            cfg = _smtp_config()
+
+            if not all([cfg['sender'], cfg['password']]):
                 print("Email config not set up")
                 return False
-            
+
             msg = MIMEMultipart('alternative')
             msg['Subject'] = subject
-            msg['From'] = sender_email
+            msg['From'] = cfg['sender']
             msg['To'] = to_email
-            
+
             # Attach text and HTML versions
             part1 = MIMEText(body, 'plain')
             msg.attach(part1)
-            
+
             if html_body:
                 part2 = MIMEText(html_body, 'html')
                 msg.attach(part2)
-            
-            # Send email
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.starttls()
-                server.login(sender_email, sender_password)
-                server.send_message(msg)
-            
+
+            # Hand off to the outbox; the worker reuses one authenticated
+            # SMTP session instead of handshaking per mail
+            _ensure_mail_worker()
+            _MAIL_OUTBOX.put(msg)
+
             return True
         except Exception as e:
             print(f"Email sending error: {e}")
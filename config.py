@@ -4,37 +4,59 @@ Handles environment variables and app settings
 """
 
 import os
-from dotenv import load_dotenv
 
-load_dotenv()
+# Production deployments get real environment variables; only parse the
+# .env file (stat + read + line-by-line parse on every boot) elsewhere
+if os.getenv('ENVIRONMENT', 'development') != 'production':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+# One snapshot of the environment, taken right after .env is merged in.
+# Every os.getenv goes through the os._Environ wrapper (key encoding and
+# all); settings below read this plain dict instead
+_ENV = dict(os.environ)
+
+
+def _int(key, default):
+    """Integer setting from the snapshot"""
+    return int(_ENV.get(key, default))
+
+
+def _bool(key, default='False'):
+    """Boolean setting from the snapshot ('True' is truthy, all else not)"""
+    return _ENV.get(key, default) == 'True'
+
 
 class Config:
     """Base configuration"""
-    
+
     # Supabase
-    SUPABASE_URL = os.getenv('SUPABASE_URL')
-    SUPABASE_KEY = os.getenv('SUPABASE_ANON_KEY')
-    SUPABASE_SERVICE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
-    
+    SUPABASE_URL = _ENV.get('SUPABASE_URL')
+    SUPABASE_KEY = _ENV.get('SUPABASE_ANON_KEY')
+    SUPABASE_SERVICE_KEY = _ENV.get('SUPABASE_SERVICE_ROLE_KEY')
+
     # Flask
-    DEBUG = os.getenv('DEBUG', 'False') == 'True'
-    PORT = int(os.getenv('PORT', 5000))
-    HOST = os.getenv('HOST', '0.0.0.0')
-    
+    DEBUG = _bool('DEBUG')
+    PORT = _int('PORT', 5000)
+    HOST = _ENV.get('HOST', '0.0.0.0')
+
     # Video Processing
-    YOLO_MODEL = os.getenv('YOLO_MODEL', 'yolov8n.pt')
-    VIDEO_UPLOAD_FOLDER = os.getenv('VIDEO_UPLOAD_FOLDER', './uploads')
-    MAX_VIDEO_SIZE_MB = int(os.getenv('MAX_VIDEO_SIZE_MB', 500))
-    
-    # Notifications
-    SMTP_SERVER = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-    SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
-    SMTP_EMAIL = os.getenv('SMTP_EMAIL')
-    SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
-    
+    YOLO_MODEL = _ENV.get('YOLO_MODEL', 'yolov8n.pt')
+    VIDEO_UPLOAD_FOLDER = _ENV.get('VIDEO_UPLOAD_FOLDER', './uploads')
+    MAX_VIDEO_SIZE_MB = _int('MAX_VIDEO_SIZE_MB', 500)
+
+    # Notifications (read once at import; per-instance os.getenv calls
+    # hit the OS environment block on every alert-service construction)
+    SMTP_SERVER = _ENV.get('SMTP_SERVER', 'smtp.gmail.com')
+    SMTP_PORT = _int('SMTP_PORT', 587)
+    SMTP_EMAIL = _ENV.get('SMTP_EMAIL')
+    SMTP_PASSWORD = _ENV.get('SMTP_PASSWORD')
+    SENDER_EMAIL = _ENV.get('SENDER_EMAIL')
+    SENDER_PASSWORD = _ENV.get('SENDER_PASSWORD')
+
     # Processing
-    STABLE_VEHICLE_THRESHOLD_MINUTES = int(os.getenv('STABLE_VEHICLE_THRESHOLD_MINUTES', 10))
-    CONGESTION_THRESHOLD_VEHICLES = int(os.getenv('CONGESTION_THRESHOLD_VEHICLES', 30))
+    STABLE_VEHICLE_THRESHOLD_MINUTES = _int('STABLE_VEHICLE_THRESHOLD_MINUTES', 10)
+    CONGESTION_THRESHOLD_VEHICLES = _int('CONGESTION_THRESHOLD_VEHICLES', 30)
 
 
 class DevelopmentConfig(Config):
@@ -47,7 +69,13 @@ class ProductionConfig(Config):
     DEBUG = False
 
 
+# ENVIRONMENT is resolved exactly once, when this module is imported —
+# the setting cannot change for the life of the process anyway
+_CONFIG = (DevelopmentConfig()
+           if _ENV.get('ENVIRONMENT', 'development') == 'development'
+           else ProductionConfig())
+
+
 def get_config():
-    """Get configuration based on environment"""
-    env = os.getenv('ENVIRONMENT', 'development')
-    return DevelopmentConfig() if env == 'development' else ProductionConfig()
+    """Get the configuration singleton for the current environment"""
+    return _CONFIG
@@ -0,0 +1,26 @@
+"""
+Gunicorn configuration for the Track-V backend
+
+The app is deliberately NOT preloaded: importing main:app constructs
+AuthManager at module scope, which opens the connection pool's sockets
+and starts the last-login writer thread — preloading would do that in
+the master pre-fork (sockets shared across workers, thread lost to
+them), and the gevent worker must monkey-patch before the app imports.
+Each worker imports the app itself after the fork.
+"""
+
+import multiprocessing
+
+workers = 2 * multiprocessing.cpu_count() + 1
+worker_class = 'gevent'
+worker_connections = 1000
+
+def post_fork(server, worker):
+    """Make psycopg2 cooperate with gevent before the app imports
+
+    psycopg2 is a C extension, so gevent's monkey-patching doesn't reach
+    it — without psycogreen's wait callback every DB call blocks the
+    worker's whole hub, serializing all greenlets behind one query.
+    """
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -1,28 +1,49 @@
-from flask import Flask, jsonify
+from flask import Flask
 from flask_cors import CORS
-from backend.api.routes import api_bp
+from functools import lru_cache
+from datetime import datetime
 import os
 from dotenv import load_dotenv
 
-load_dotenv()
+from backend.api.responses import ojsonify
 
-app = Flask(__name__)
-CORS(app)
+@lru_cache(maxsize=1)
+def _load_env():
+    """Read .env once per process, not once per import of this module"""
+    load_dotenv(override=False)
+    return True
 
-# Register blueprints
-app.register_blueprint(api_bp)
+def create_app():
+    """Application factory: build and wire a fresh Flask app
 
-@app.route('/', methods=['GET'])
-def health_check():
-    return jsonify({'status': 'ok', 'message': 'Track-V API Server Running'}), 200
+    Importing the blueprint here (not at module import time) keeps startup
+    cheap for tooling that only needs create_app, and lets each gunicorn
+    worker construct its own app after fork.
+    """
+    _load_env()
 
-@app.route('/api/health', methods=['GET'])
-def api_health():
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': __import__('datetime').datetime.utcnow().isoformat(),
-        'service': 'Track-V Traffic Optimizer'
-    }), 200
+    app = Flask(__name__)
+    CORS(app)
+
+    # Register blueprints
+    from backend.api.routes import api_bp
+    app.register_blueprint(api_bp)
+
+    @app.route('/', methods=['GET'])
+    def health_check():
+        return ojsonify({'status': 'ok', 'message': 'Track-V API Server Running'}, 200)
+
+    @app.route('/api/health', methods=['GET'])
+    def api_health():
+        return ojsonify({
+            'status': 'healthy',
+            'timestamp': datetime.utcnow().isoformat(),
+            'service': 'Track-V Traffic Optimizer'
+        }, 200)
+
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
@@ -2,125 +2,332 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from typing import List, Dict
-import os
+import html
 import logging
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from string import Template
+
+from cachetools import TTLCache
+from psycopg2.extras import NamedTupleCursor, execute_values
+
+from backend.config import Config
 
 logger = logging.getLogger(__name__)
 
+# Email/SMS sends run here so create_alert returns right after its INSERT
+# instead of blocking the request thread on SMTP round trips
+_DISPATCH_POOL = ThreadPoolExecutor(max_workers=4,
+                                    thread_name_prefix='alert-dispatch')
+
+# Compiled once at import; the body is identical for every recipient of an
+# alert, so it is rendered once per alert rather than once per send
+_EMAIL_HTML_TEMPLATE = Template("""
+<html>
+    <body style="font-family: Arial, sans-serif; background-color: #f5f5f5;">
+        <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 20px; border-radius: 8px;">
+            <h2 style="color: #ff8c42;">Alert Notification</h2>
+            <h3>$title</h3>
+            <p><strong>Description:</strong> $description</p>
+            <p><strong>Time:</strong> $timestamp</p>
+            <p>
+                <a href="#" style="background-color: #ff8c42; color: white; padding: 10px 20px; text-decoration: none; border-radius: 4px;">
+                    View Details
+                </a>
+            </p>
+        </div>
+    </body>
+</html>
+""")
+
+_EMAIL_TEXT_TEMPLATE = Template(
+    "Alert: $title\n\n$description\n\nTime: $timestamp")
+
+# Bad enum values fail here in microseconds instead of round-tripping to
+# the database for a constraint violation, rollback and log
+_VALID_SEVERITIES = frozenset(('low', 'medium', 'high', 'critical'))
+_VALID_ALERT_TYPES = frozenset(('bottleneck', 'stable_vehicle',
+                                'high_congestion'))
+
+# Bottleneck thresholds, hoisted so the per-frame check compares against
+# locals-fast constants instead of rebuilding literals inside a try block
+_VEHICLE_THRESHOLD = 100
+_STABLE_THRESHOLD = 5
+_CRITICAL_STABLE_THRESHOLD = 10
+
+# Planned once per connection; EXECUTE then skips the parse/plan phase
+# that dominates server time on these small statements
+_ALERT_STATEMENTS = (
+    """PREPARE alert_insert AS
+       INSERT INTO alerts
+       (junction_id, alert_type, severity, title, description, created_by)
+       VALUES ($1, $2, $3, $4, $5, $6)
+       RETURNING id""",
+    """PREPARE alert_email_inspectors AS
+       SELECT i.id, u.email
+       FROM inspectors i
+       JOIN users u ON i.user_id = u.id
+       WHERE i.junction_id = $1
+         AND i.email_notification_enabled""",
+    """PREPARE alert_sms_inspectors AS
+       SELECT i.id, i.phone_number
+       FROM inspectors i
+       WHERE i.junction_id = $1
+         AND i.sms_notification_enabled
+         AND i.phone_number IS NOT NULL""",
+)
+
 class AlertService:
     """Service to manage and send alerts"""
-    
-    def __init__(self, db_connection):
-        self.db_connection = db_connection
-        self.smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        self.smtp_port = int(os.getenv('SMTP_PORT', 587))
-        self.sender_email = os.getenv('SENDER_EMAIL')
-        self.sender_password = os.getenv('SENDER_PASSWORD')
+
+    # Notification-log writer commits at most this many rows per batch
+    LOG_BATCH_SIZE = 100
+
+    # A junction re-fires the same alert type at most once per cooldown,
+    # unless the severity escalates in the meantime
+    ALERT_COOLDOWN_SECONDS = 300
+
+    # Bottleneck thresholds are evaluated at most this often per junction;
+    # congestion builds over seconds, not frames
+    CHECK_INTERVAL_SECONDS = 1.0
+    SEVERITY_RANK = {'low': 0, 'medium': 1, 'high': 2, 'critical': 3}
+
+    def __init__(self, db_pool):
+        # Pooled connections let the dispatch threads and log writer hit
+        # the database concurrently instead of serializing on one session
+        self.db_pool = db_pool
+        # SMTP settings are read from the environment once, at config import
+        self.smtp_server = Config.SMTP_SERVER
+        self.smtp_port = Config.SMTP_PORT
+        self.sender_email = Config.SENDER_EMAIL
+        self.sender_password = Config.SENDER_PASSWORD
+        # One authenticated SMTP session reused across sends; a new
+        # TCP+TLS+AUTH handshake per recipient dominated fan-out time
+        self._smtp = None
+        self._smtp_lock = threading.Lock()
+        # Each send used to INSERT+commit its own log row — two round
+        # trips and an fsync per (inspector, channel). Rows now queue up
+        # and a writer thread commits them in batches
+        self._log_queue = queue.Queue(maxsize=10000)
+        threading.Thread(target=self._log_writer, name='alert-log-writer',
+                         daemon=True).start()
+        # Inspector rosters change on the order of days; alerts can fire
+        # per frame. Five minutes of staleness spares a join per alert
+        self._inspector_cache = TTLCache(maxsize=256, ttl=300)
+        self._inspector_cache_lock = threading.Lock()
+        # (junction_id, alert_type) -> (last fired at, severity)
+        self._last_alert_at = {}
+        # junction_id -> monotonic time of its last bottleneck check
+        self._last_check_at = {}
+        # Statements are prepared per connection; track which pool members
+        # have seen PREPARE without keeping them alive
+        self._prepared_conns = weakref.WeakKeyDictionary()
+
+    @contextmanager
+    def _cursor(self, cursor_factory=None):
+        """Check out a pooled connection and yield a cursor on it
+
+        Commits on clean exit, rolls back on error, and always returns
+        the connection to the pool — cursors no longer leak on raise.
+        """
+        conn = self.db_pool.getconn()
+        try:
+            self._ensure_prepared(conn)
+            with conn.cursor(cursor_factory=cursor_factory) as cursor:
+                yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.db_pool.putconn(conn)
+
+    def _ensure_prepared(self, conn):
+        """PREPARE the hot alert statements once per pooled connection"""
+        if conn in self._prepared_conns:
+            return
+        with conn.cursor() as cursor:
+            for statement in _ALERT_STATEMENTS:
+                cursor.execute(statement)
+        conn.commit()
+        self._prepared_conns[conn] = True
+
+    def _get_recipients(self, junction_id: str):
+        """Per-channel recipient lists for a junction, cached five minutes
+
+        The enabled/phone filters live in the WHERE clause, so inspectors
+        who opted out never leave the server — and the SMS query skips the
+        users join entirely since it only needs the phone number.
+        """
+        with self._inspector_cache_lock:
+            recipients = self._inspector_cache.get(junction_id)
+        if recipients is not None:
+            return recipients
+
+        with self._cursor(cursor_factory=NamedTupleCursor) as cursor:
+            cursor.execute("EXECUTE alert_email_inspectors (%s)",
+                           (junction_id,))
+            email_recipients = []
+            for chunk in iter(lambda: cursor.fetchmany(64), []):
+                email_recipients.extend(chunk)
+
+            cursor.execute("EXECUTE alert_sms_inspectors (%s)",
+                           (junction_id,))
+            sms_recipients = []
+            for chunk in iter(lambda: cursor.fetchmany(64), []):
+                sms_recipients.extend(chunk)
+
+        recipients = (email_recipients, sms_recipients)
+        with self._inspector_cache_lock:
+            self._inspector_cache[junction_id] = recipients
+        return recipients
+
+    def invalidate_junction(self, junction_id: str):
+        """Drop a junction's cached roster after inspector CRUD"""
+        with self._inspector_cache_lock:
+            self._inspector_cache.pop(junction_id, None)
+
+    def _log_writer(self):
+        """Collect queued log rows for up to a second, then commit them"""
+        while True:
+            rows = [self._log_queue.get()]
+            deadline = time.time() + 1.0
+            while len(rows) < self.LOG_BATCH_SIZE:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._log_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush_notification_logs(rows)
+
+    def _flush_notification_logs(self, rows):
+        """Insert buffered notification logs in one statement"""
+        try:
+            with self._cursor() as cursor:
+                execute_values(cursor, """
+                    INSERT INTO alert_notifications
+                    (alert_id, inspector_id, notification_method, status)
+                    VALUES %s
+                """, rows)
+        except Exception as e:
+            logger.error("Error logging notifications: %s", e)
+
+    def _get_smtp(self):
+        """Return a live, logged-in SMTP connection (caller holds the lock)
+
+        An existing session is health-checked with noop(); if the server
+        dropped it, a fresh connection is opened and authenticated.
+        """
+        if self._smtp is not None:
+            try:
+                self._smtp.noop()
+                return self._smtp
+            except (smtplib.SMTPException, OSError):
+                try:
+                    self._smtp.close()
+                except Exception:
+                    pass
+                self._smtp = None
+
+        server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+        server.starttls()
+        server.login(self.sender_email, self.sender_password)
+        self._smtp = server
+        return server
         
     def create_alert(self, junction_id: str, alert_type: str, 
                     severity: str, title: str, description: str, 
                     created_by: str) -> str:
         """Create a new alert"""
+        if severity not in _VALID_SEVERITIES:
+            raise ValueError(f"Invalid severity: {severity!r}")
+        if alert_type not in _VALID_ALERT_TYPES:
+            raise ValueError(f"Invalid alert type: {alert_type!r}")
+
         try:
-            cursor = self.db_connection.cursor()
-            cursor.execute("""
-                INSERT INTO alerts 
-                (junction_id, alert_type, severity, title, description, created_by)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                RETURNING id
-            """, (junction_id, alert_type, severity, title, description, created_by))
-            
-            alert_id = cursor.fetchone()[0]
-            self.db_connection.commit()
-            
+            with self._cursor() as cursor:
+                cursor.execute(
+                    "EXECUTE alert_insert (%s, %s, %s, %s, %s, %s)",
+                    (junction_id, alert_type, severity, title, description,
+                     created_by))
+
+                alert_id = cursor.fetchone()[0]
+
             # Send notifications to inspectors
             self.send_notifications_to_inspectors(junction_id, alert_id, title, description)
-            
-            cursor.close()
+
             return alert_id
         except Exception as e:
-            logger.error(f"Error creating alert: {e}")
-            self.db_connection.rollback()
+            logger.error("Error creating alert: %s", e)
             raise
     
     def send_notifications_to_inspectors(self, junction_id: str, alert_id: str, 
                                         title: str, description: str):
         """Send notifications to all inspectors of a junction"""
         try:
-            cursor = self.db_connection.cursor()
-            cursor.execute("""
-                SELECT i.id, u.email, i.phone_number, 
-                       i.email_notification_enabled, i.sms_notification_enabled
-                FROM inspectors i
-                JOIN users u ON i.user_id = u.id
-                WHERE i.junction_id = %s
-            """, (junction_id,))
-            
-            inspectors = cursor.fetchall()
-            
-            for inspector in inspectors:
-                inspector_id, email, phone, email_enabled, sms_enabled = inspector
-                
-                if email_enabled:
-                    self.send_email_alert(email, title, description, inspector_id, alert_id)
-                
-                if sms_enabled and phone:
-                    self.send_sms_alert(phone, title, description, inspector_id, alert_id)
-            
-            cursor.close()
+            email_recipients, sms_recipients = \
+                self._get_recipients(junction_id)
+
+            # Fan out in the background; each send logs its own outcome
+            if email_recipients:
+                # Body and MIME tree are identical for every recipient —
+                # render and serialize them once per alert, not once per
+                # inspector; recipients are addressed via the SMTP envelope
+                raw = self._build_alert_message(title, description).as_bytes()
+                for inspector in email_recipients:
+                    _DISPATCH_POOL.submit(self.send_email_alert, raw,
+                                          inspector.email, inspector.id,
+                                          alert_id)
+
+            for inspector in sms_recipients:
+                _DISPATCH_POOL.submit(self.send_sms_alert,
+                                      inspector.phone_number, title,
+                                      description, inspector.id, alert_id)
         except Exception as e:
-            logger.error(f"Error sending notifications: {e}")
-    
-    def send_email_alert(self, to_email: str, title: str, description: str, 
+            logger.error("Error sending notifications: %s", e)
+
+    def _build_alert_message(self, title: str, description: str) -> MIMEMultipart:
+        """Build the shared alert email, escaped for the HTML part"""
+        timestamp = datetime.utcnow().isoformat()
+
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = f"Track-V Alert: {title}"
+        msg['From'] = self.sender_email
+
+        msg.attach(MIMEText(_EMAIL_TEXT_TEMPLATE.substitute(
+            title=title, description=description, timestamp=timestamp),
+            'plain'))
+        # Titles/descriptions can carry user-entered text; escape so it
+        # can't break out of the markup
+        msg.attach(MIMEText(_EMAIL_HTML_TEMPLATE.substitute(
+            title=html.escape(title),
+            description=html.escape(description),
+            timestamp=timestamp),
+            'html'))
+
+        return msg
+
+    def send_email_alert(self, raw: bytes, to_email: str,
                         inspector_id: str, alert_id: str) -> bool:
-        """Send email alert"""
+        """Send a pre-serialized alert email to one recipient"""
         try:
-            subject = f"Track-V Alert: {title}"
-            
-            html_body = f"""
-            <html>
-                <body style="font-family: Arial, sans-serif; background-color: #f5f5f5;">
-                    <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 20px; border-radius: 8px;">
-                        <h2 style="color: #ff8c42;">Alert Notification</h2>
-                        <h3>{title}</h3>
-                        <p><strong>Description:</strong> {description}</p>
-                        <p><strong>Time:</strong> {datetime.utcnow().isoformat()}</p>
-                        <p>
-                            <a href="#" style="background-color: #ff8c42; color: white; padding: 10px 20px; text-decoration: none; border-radius: 4px;">
-                                View Details
-                            </a>
-                        </p>
-                    </div>
-                </body>
-            </html>
-            """
-            
-            text_body = f"Alert: {title}\n\n{description}\n\nTime: {datetime.utcnow().isoformat()}"
-            
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = subject
-            msg['From'] = self.sender_email
-            msg['To'] = to_email
-            
-            part1 = MIMEText(text_body, 'plain')
-            part2 = MIMEText(html_body, 'html')
-            
-            msg.attach(part1)
-            msg.attach(part2)
-            
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.sender_email, self.sender_password)
-                server.send_message(msg)
+            with self._smtp_lock:
+                self._get_smtp().sendmail(self.sender_email, [to_email], raw)
             
             # Log notification
             self._log_notification(inspector_id, alert_id, 'email', 'sent')
-            logger.info(f"Email sent to {to_email}")
+            logger.info("Email sent to %s", to_email)
             return True
             
         except Exception as e:
-            logger.error(f"Error sending email: {e}")
+            logger.error("Error sending email: %s", e)
             self._log_notification(inspector_id, alert_id, 'email', 'failed')
             return False
     
@@ -138,48 +345,79 @@ class AlertService:
             #     body=f"{title}: {description}"
             # )
             
-            logger.info(f"SMS sent to {phone_number}: {title}")
+            logger.info("SMS sent to %s: %s", phone_number, title)
             self._log_notification(inspector_id, alert_id, 'sms', 'sent')
             return True
             
         except Exception as e:
-            logger.error(f"Error sending SMS: {e}")
+            logger.error("Error sending SMS: %s", e)
             self._log_notification(inspector_id, alert_id, 'sms', 'failed')
             return False
     
-    def _log_notification(self, inspector_id: str, alert_id: str, 
+    def _log_notification(self, inspector_id: str, alert_id: str,
                          method: str, status: str):
-        """Log notification to database"""
+        """Queue a notification log row for the batch writer; never blocks"""
         try:
-            cursor = self.db_connection.cursor()
-            cursor.execute("""
-                INSERT INTO alert_notifications 
-                (alert_id, inspector_id, notification_method, status)
-                VALUES (%s, %s, %s, %s)
-            """, (alert_id, inspector_id, method, status))
-            
-            self.db_connection.commit()
-            cursor.close()
-        except Exception as e:
-            logger.error(f"Error logging notification: {e}")
+            self._log_queue.put_nowait((alert_id, inspector_id, method, status))
+        except queue.Full:
+            logger.warning("Notification log queue full; dropping %s "
+                           "log for alert %s", method, alert_id)
     
-    def detect_bottleneck_and_alert(self, junction_id: str, vehicle_count: int, 
+    def _should_fire(self, junction_id: str, alert_type: str,
+                    severity: str) -> bool:
+        """True unless an equal-or-worse alert fired within the cooldown
+
+        Called per analyzed frame: a jam that persists for ten minutes
+        must not insert thousands of identical rows and re-mail every
+        inspector each frame. An escalation in severity fires immediately.
+        """
+        last = self._last_alert_at.get((junction_id, alert_type))
+        if last is None:
+            return True
+        last_at, last_severity = last
+        if time.time() - last_at >= self.ALERT_COOLDOWN_SECONDS:
+            return True
+        return (self.SEVERITY_RANK.get(severity, 0) >
+                self.SEVERITY_RANK.get(last_severity, 0))
+
+    def detect_bottleneck_and_alert(self, junction_id: str, vehicle_count: int,
                                    stable_vehicles: int):
-        """Detect bottleneck situation and create alert"""
+        """Detect bottleneck situation and create alert
+
+        Runs per analyzed frame; a sliding window coalesces calls so a
+        junction's thresholds are checked about once a second, and the
+        common path out is a dict probe plus two integer compares.
+        """
+        now = time.monotonic()
+        if now - self._last_check_at.get(junction_id, 0.0) < \
+                self.CHECK_INTERVAL_SECONDS:
+            return
+        self._last_check_at[junction_id] = now
+
+        if vehicle_count <= _VEHICLE_THRESHOLD and \
+                stable_vehicles <= _STABLE_THRESHOLD:
+            return
+
+        alert_type = 'bottleneck'
+        severity = ('critical' if stable_vehicles > _CRITICAL_STABLE_THRESHOLD
+                    else 'high')
+
+        if not self._should_fire(junction_id, alert_type, severity):
+            return
+
+        title = f"Traffic Bottleneck Detected at Junction {junction_id}"
+        description = f"High congestion: {vehicle_count} vehicles, {stable_vehicles} stable for 10+ mins"
+
         try:
-            if vehicle_count > 100 or stable_vehicles > 5:
-                alert_type = 'bottleneck'
-                severity = 'critical' if stable_vehicles > 10 else 'high'
-                title = f"Traffic Bottleneck Detected at Junction {junction_id}"
-                description = f"High congestion: {vehicle_count} vehicles, {stable_vehicles} stable for 10+ mins"
-                
-                self.create_alert(
-                    junction_id=junction_id,
-                    alert_type=alert_type,
-                    severity=severity,
-                    title=title,
-                    description=description,
-                    created_by='system'
-                )
+            self.create_alert(
+                junction_id=junction_id,
+                alert_type=alert_type,
+                severity=severity,
+                title=title,
+                description=description,
+                created_by='system'
+            )
+            self._last_alert_at[(junction_id, alert_type)] = \
+                (time.time(), severity)
         except Exception as e:
-            logger.error(f"Error detecting bottleneck: {e}")
+            logger.error("Error detecting bottleneck: %s", e)
@@ -0,0 +1,183 @@
+"""
+Celery tasks for asynchronous notification dispatch
+Alert creation returns after the DB insert; email/SMS fan out on workers
+"""
+
+import os
+import time
+import logging
+from celery import Celery
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+celery = Celery('trackv', broker=os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+
+# Fail fast when the broker is down: without these, a publish walks
+# kombu's full connect-and-retry cycle before raising, stalling the
+# request thread for seconds before the local fallback kicks in
+celery.conf.broker_connection_timeout = 1
+celery.conf.task_publish_retry = False
+
+# Fallback executor: when no broker is reachable, sends still leave the
+# request thread and run here instead
+_notif_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='notif')
+
+# Cached broker health so a dead broker costs one bounded probe every
+# recheck window instead of a connect attempt on every send
+_BROKER_RECHECK_SECONDS = 30.0
+_broker_ok = None
+_broker_checked_at = 0.0
+
+def _broker_available():
+    """Probe the broker, caching the verdict for _BROKER_RECHECK_SECONDS"""
+    global _broker_ok, _broker_checked_at
+    now = time.monotonic()
+    if _broker_ok is None or now - _broker_checked_at >= _BROKER_RECHECK_SECONDS:
+        try:
+            conn = celery.connection_for_write()
+            try:
+                conn.ensure_connection(max_retries=1, timeout=1)
+            finally:
+                conn.release()
+            _broker_ok = True
+        except Exception:
+            _broker_ok = False
+        _broker_checked_at = now
+    return _broker_ok
+
+def _submit_local(task, *args):
+    future = _notif_pool.submit(task.run, *args)
+    future.add_done_callback(_log_task_error)
+
+def _log_task_error(future):
+    exc = future.exception()
+    if exc:
+        logger.error(f"Notification task failed: {exc}")
+
+def submit_or_delay(task, *args):
+    """Enqueue on Celery, falling back to the local thread pool
+
+    Task errors on the fallback path are surfaced through a done-callback
+    since nobody waits on the future.
+    """
+    global _broker_ok
+    if not _broker_available():
+        _submit_local(task, *args)
+        return
+    try:
+        task.delay(*args)
+    except Exception as e:
+        logger.warning(f"Celery broker unavailable ({e}); using local thread pool")
+        _broker_ok = False
+        _submit_local(task, *args)
+
+_auth_manager = None
+
+def _get_auth_manager():
+    """Lazy per-worker AuthManager (owns the DB pool and SMTP config)
+
+    This module is imported both as backend.notifications.tasks (API
+    package) and notifications.tasks (app.py), so try both roots.
+    """
+    global _auth_manager
+    if _auth_manager is None:
+        try:
+            from backend.auth.auth_manager import AuthManager
+        except ImportError:
+            from auth.auth_manager import AuthManager
+        _auth_manager = AuthManager()
+    return _auth_manager
+
+_supabase = None
+
+def _get_supabase():
+    """Lazy Supabase client for processes deployed without POSTGRES_* config"""
+    global _supabase
+    if _supabase is None:
+        from supabase import create_client
+        _supabase = create_client(
+            os.getenv('SUPABASE_URL'),
+            os.getenv('SUPABASE_SERVICE_ROLE_KEY') or os.getenv('SUPABASE_ANON_KEY')
+        )
+    return _supabase
+
+def _lookup_user_contact(user_id):
+    """Fetch (email, phone_number) for a user, or None if unknown
+
+    Uses the psycopg2 pool where POSTGRES_HOST is configured; the web
+    process runs against Supabase over HTTP only, so without it the
+    lookup goes through PostgREST instead.
+    """
+    if os.getenv('POSTGRES_HOST'):
+        auth_manager = _get_auth_manager()
+        with auth_manager.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT email, phone_number FROM users WHERE id = %s", (user_id,)
+                )
+                return cursor.fetchone()
+
+    response = _get_supabase().table('users') \
+        .select('email, phone_number').eq('id', user_id).execute()
+    if not response.data:
+        return None
+    user = response.data[0]
+    return user.get('email'), user.get('phone_number')
+
+@celery.task(name='notifications.tasks.dispatch_alert')
+def dispatch_alert(alert_id, junction_id, title, description):
+    """Fan an alert out to every inspector assigned to the junction"""
+    auth_manager = _get_auth_manager()
+    with auth_manager.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT i.id, u.email, i.phone_number, i.email_notification_enabled,
+                       i.sms_notification_enabled
+                FROM inspectors i
+                JOIN users u ON i.user_id = u.id
+                WHERE i.junction_id = %s
+            """, (junction_id,))
+
+            inspectors = cursor.fetchall()
+
+    for inspector in inspectors:
+        if inspector[3]:  # email_notification_enabled
+            submit_or_delay(send_alert_email, inspector[1], f"Alert: {title}", description or '')
+        if inspector[4]:  # sms_notification_enabled
+            submit_or_delay(send_alert_sms, inspector[2], title)
+
+@celery.task(name='notifications.tasks.dispatch_notification')
+def dispatch_notification(user_id, notification_type, message):
+    """Deliver a stored notification to a single user"""
+    row = _lookup_user_contact(user_id)
+
+    if not row:
+        logger.warning(f"Notification for unknown user {user_id} dropped")
+        return
+
+    email, phone_number = row
+    if notification_type == 'sms':
+        submit_or_delay(send_alert_sms, phone_number, message)
+    else:
+        submit_or_delay(send_alert_email, email, 'Track-V Notification', message)
+
+@celery.task(name='notifications.tasks.send_alert_email')
+def send_alert_email(to_email, subject, body):
+    """Send one email on the notifications_email queue"""
+    _get_auth_manager().send_notification_email(to_email, subject, body)
+
+@celery.task(name='notifications.tasks.send_alert_sms')
+def send_alert_sms(phone_number, message):
+    """Send one SMS on the notifications_sms queue"""
+    _get_auth_manager().send_sms(phone_number, message)
+
+# Per-channel queues so slow SMTP never backs up SMS delivery (and vice
+# versa). Task names are pinned on the decorators above — the module is
+# imported under two roots and auto-generated names would differ between
+# them — and the routes reuse those names so they always match what the
+# callers enqueue.
+celery.conf.task_routes = {
+    send_alert_email.name: {'queue': 'notifications_email'},
+    send_alert_sms.name: {'queue': 'notifications_sms'},
+}
@@ -0,0 +1,9 @@
+-- Indexes backing /api/analysis/results: newest-first scans, optionally
+-- filtered by junction. CONCURRENTLY avoids locking writes during the
+-- backfill; run these outside a transaction block.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_traffic_analysis_junction_ts
+    ON traffic_analysis_results (junction_id, analysis_timestamp DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_traffic_analysis_ts
+    ON traffic_analysis_results (analysis_timestamp DESC);
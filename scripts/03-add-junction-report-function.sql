@@ -0,0 +1,21 @@
+-- Aggregates detection stats for CongestionAnalyzer.generate_report in a
+-- single query instead of shipping every vehicle_detections row over
+-- PostgREST. Called through supabase.rpc('get_junction_report', ...).
+
+CREATE OR REPLACE FUNCTION get_junction_report(jid INTEGER, since DATE)
+RETURNS TABLE (
+    detection_count BIGINT,
+    total_vehicles BIGINT,
+    average_vehicles NUMERIC,
+    peak_vehicles INTEGER
+)
+LANGUAGE sql STABLE
+AS $$
+    SELECT COUNT(*),
+           COALESCE(SUM(vehicle_count), 0),
+           COALESCE(ROUND(AVG(vehicle_count), 2), 0),
+           COALESCE(MAX(vehicle_count), 0)
+    FROM vehicle_detections
+    WHERE junction_id = jid
+      AND created_at >= since;
+$$;
@@ -0,0 +1,11 @@
+-- Covering index for the alert fan-out lookup (alert_inspectors): every
+-- alert resolves a junction's inspector roster, and without this the
+-- planner seq-scans inspectors before joining users. INCLUDE carries the
+-- notification columns so the inspectors side is an index-only scan; the
+-- users join stays on its primary key. CONCURRENTLY avoids locking
+-- writes during the backfill; run outside a transaction block.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_inspectors_junction
+    ON inspectors (junction_id)
+    INCLUDE (user_id, phone_number,
+             email_notification_enabled, sms_notification_enabled);
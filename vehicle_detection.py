@@ -4,6 +4,12 @@ Handles stable vehicle detection and alert generation
 """
 
 import json
+import threading
+import time
+import numpy as np
+from cachetools import TTLCache
+from psycopg2.extras import execute_values
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import List, Dict
 import logging
@@ -16,17 +22,239 @@ class CongestionAnalyzer:
     Analyzes vehicle detections to identify congestion patterns and stable vehicles
     """
 
-    def __init__(self, supabase_client):
+    # Tracking state capacity and how long an idle junction may linger
+    # before it is pruned
+    MAX_TRACKED_JUNCTIONS = 4096
+    STALE_AFTER_SECONDS = 1800
+
+    def __init__(self, supabase_client, db_pool=None):
         self.supabase = supabase_client
-        self.vehicle_tracking = {}
+        # Optional psycopg2 pool (e.g. AuthManager.db_pool): when present,
+        # hot-path alert inserts go straight to Postgres instead of through
+        # the HTTPS PostgREST client, dropping an HTTP+JSON round trip from
+        # the per-frame detection loop
+        self.db_pool = db_pool
         self.stable_threshold_minutes = 10  # Alert after 10 minutes of stability
+        # Tracking state lives in parallel arrays (structure-of-arrays)
+        # instead of a dict of dicts: slot lookups are one dict hit, the
+        # stale sweep is a single vectorized comparison, and idle junctions
+        # no longer leak (entries used to persist until count dropped < 10)
+        # Detection threads for different feeds share this analyzer, so all
+        # slot-map mutations happen under one lock
+        self._tracking_lock = threading.RLock()
+        self._slot_by_junction = {}
+        self._free_slots = list(range(self.MAX_TRACKED_JUNCTIONS - 1, -1, -1))
+        self._first_detected = np.zeros(self.MAX_TRACKED_JUNCTIONS, dtype=np.float64)
+        self._last_update = np.zeros(self.MAX_TRACKED_JUNCTIONS, dtype=np.float64)
+        self._vehicle_count = np.zeros(self.MAX_TRACKED_JUNCTIONS, dtype=np.int32)
+        self._last_prune = time.time()
+        # Inspector/junction/officer metadata changes rarely while alerts
+        # fire every frame; cache lookups and overlap the misses
+        self._lookup_cache = TTLCache(maxsize=1024, ttl=300)
+        self._lookup_pool = ThreadPoolExecutor(max_workers=3,
+                                               thread_name_prefix='notif-lookup')
+
+    def _insert_alert(self, alert_data: Dict) -> Dict:
+        """Insert a congestion alert, preferring the direct DB connection"""
+        if self.db_pool is None:
+            result = self.supabase.table("congestion_alerts").insert(alert_data).execute()
+            return result.data[0]
+
+        conn = self.db_pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO congestion_alerts
+                    (junction_id, video_feed_id, alert_type,
+                     stable_duration_minutes, alert_status)
+                    VALUES (%s, %s, %s, %s, %s)
+                    RETURNING id
+                """, (alert_data["junction_id"], alert_data["video_feed_id"],
+                      alert_data["alert_type"], alert_data["stable_duration_minutes"],
+                      alert_data["alert_status"]))
+                alert_id = cursor.fetchone()[0]
+            conn.commit()
+            return {**alert_data, "id": alert_id}
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.db_pool.putconn(conn)
+
+    def _insert_alerts(self, rows: List[Dict]) -> List[Dict]:
+        """Insert many congestion alerts in one round trip"""
+        if not rows:
+            return []
+        if self.db_pool is None:
+            result = self.supabase.table("congestion_alerts").insert(rows).execute()
+            return result.data or []
+
+        conn = self.db_pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                ids = execute_values(cursor, """
+                    INSERT INTO congestion_alerts
+                    (junction_id, video_feed_id, alert_type,
+                     stable_duration_minutes, alert_status)
+                    VALUES %s
+                    RETURNING id
+                """, [(r["junction_id"], r["video_feed_id"], r["alert_type"],
+                       r["stable_duration_minutes"], r["alert_status"])
+                      for r in rows], fetch=True)
+            conn.commit()
+            return [{**row, "id": new_id[0]} for row, new_id in zip(rows, ids)]
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.db_pool.putconn(conn)
+
+    def check_and_create_alerts_bulk(self, items: List[tuple]) -> List[Dict]:
+        """Run the alert check for many junctions with O(1) round trips
+
+        items is a list of (junction_id, detections, video_feed_id). One
+        IN-query fetches existing stable alerts for every junction, the
+        per-junction logic runs in Python, and new alerts go out as a
+        single batched insert.
+        """
+        alerts_created = []
+        now_ts = time.time()
+
+        try:
+            junction_ids = [jid for jid, _, _ in items]
+            existing = self.supabase.table("congestion_alerts").select("*").in_(
+                "junction_id", junction_ids
+            ).eq("alert_status", "active").eq("alert_type", "stable_vehicle").execute()
+
+            stable_by_junction = {}
+            for alert in existing.data or []:
+                stable_by_junction.setdefault(alert["junction_id"], []).append(alert)
+
+            rows = []
+            for junction_id, detections, video_feed_id in items:
+                if detections["vehicle_count"] > 30:  # High congestion threshold
+                    rows.append({
+                        "junction_id": junction_id,
+                        "video_feed_id": video_feed_id,
+                        "alert_type": "high_congestion",
+                        "stable_duration_minutes": 0,
+                        "alert_status": "active"
+                    })
+
+                duration = self._track(junction_id, detections["vehicle_count"], now_ts)
+
+                if duration > self.stable_threshold_minutes:
+                    has_alert = any(
+                        alert["stable_duration_minutes"] >= self.stable_threshold_minutes
+                        for alert in stable_by_junction.get(junction_id, [])
+                    )
+                    if not has_alert:
+                        rows.append({
+                            "junction_id": junction_id,
+                            "video_feed_id": video_feed_id,
+                            "alert_type": "stable_vehicle",
+                            "stable_duration_minutes": int(duration),
+                            "alert_status": "active"
+                        })
+                elif detections["vehicle_count"] < 10:
+                    self._untrack(junction_id)
+
+            self._prune_stale(now_ts)
+            alerts_created = self._insert_alerts(rows)
+            if rows:
+                logger.info(f"[v0] Created {len(rows)} alerts across {len(items)} junctions")
+
+        except Exception as e:
+            logger.error(f"[v0] Error in check_and_create_alerts_bulk: {e}")
+
+        return alerts_created
+
+    def _get_inspector(self, inspector_id):
+        key = ("inspector", inspector_id)
+        if key not in self._lookup_cache:
+            result = self.supabase.table("inspectors").select("*").eq(
+                "id", inspector_id
+            ).single().execute()
+            self._lookup_cache[key] = result.data
+        return self._lookup_cache[key]
+
+    def _get_junction(self, junction_id):
+        key = ("junction", junction_id)
+        if key not in self._lookup_cache:
+            result = self.supabase.table("junctions").select("*").eq(
+                "id", junction_id
+            ).single().execute()
+            self._lookup_cache[key] = result.data
+        return self._lookup_cache[key]
+
+    def _get_officers(self, junction_id):
+        key = ("officers", junction_id)
+        if key not in self._lookup_cache:
+            result = self.supabase.table("users").select("*").eq(
+                "assigned_junction_id", junction_id
+            ).eq("user_type", "officer").execute()
+            self._lookup_cache[key] = result.data or []
+        return self._lookup_cache[key]
+
+    def _track(self, junction_id: int, vehicle_count: int, now_ts: float) -> float:
+        """Record a detection and return minutes since first sighting"""
+        with self._tracking_lock:
+            slot = self._slot_by_junction.get(junction_id)
+            if slot is None:
+                if not self._free_slots:
+                    self._prune_stale(now_ts, force=True)
+                slot = self._free_slots.pop()
+                self._slot_by_junction[junction_id] = slot
+                self._first_detected[slot] = now_ts
+            self._last_update[slot] = now_ts
+            self._vehicle_count[slot] = vehicle_count
+            return (now_ts - self._first_detected[slot]) / 60
+
+    def stable_junctions(self, now_ts: float = None) -> List[int]:
+        """Return every tracked junction stable past the alert threshold
+
+        One vectorized subtract+compare over the slot arrays; detection
+        loops can call this once per tick instead of re-deriving duration
+        per junction.
+        """
+        if now_ts is None:
+            now_ts = time.time()
+        with self._tracking_lock:
+            if not self._slot_by_junction:
+                return []
+            junction_ids = np.fromiter(self._slot_by_junction.keys(), dtype=np.int64)
+            slots = np.fromiter(self._slot_by_junction.values(), dtype=np.int64)
+        stable = (now_ts - self._first_detected[slots]) / 60 > self.stable_threshold_minutes
+        return junction_ids[stable].tolist()
+
+    def _untrack(self, junction_id: int):
+        with self._tracking_lock:
+            slot = self._slot_by_junction.pop(junction_id, None)
+            if slot is not None:
+                self._free_slots.append(slot)
+
+    def _prune_stale(self, now_ts: float, force: bool = False):
+        """Drop junctions not seen within STALE_AFTER_SECONDS in one pass"""
+        with self._tracking_lock:
+            if not force and now_ts - self._last_prune < 60:
+                return
+            self._last_prune = now_ts
+            if not self._slot_by_junction:
+                return
+            active = np.fromiter(self._slot_by_junction.values(), dtype=np.int64)
+            stale = active[now_ts - self._last_update[active] > self.STALE_AFTER_SECONDS]
+            if len(stale):
+                stale_slots = set(stale.tolist())
+                for jid, slot in list(self._slot_by_junction.items()):
+                    if slot in stale_slots:
+                        self._untrack(jid)
 
     def check_and_create_alerts(self, junction_id: int, detections: Dict, video_feed_id: int = None) -> List[Dict]:
         """
         Check detections for stable vehicles and create alerts if threshold exceeded
         """
         alerts_created = []
-        current_time = datetime.now()
+        now_ts = time.time()
 
         try:
             # Get existing stable vehicles for this junction
@@ -46,29 +274,14 @@ class CongestionAnalyzer:
                         "stable_duration_minutes": 0,
                         "alert_status": "active"
                     }
-                    alert = self.supabase.table("congestion_alerts").insert(alert_data).execute()
-                    alerts_created.append(alert.data[0])
+                    alerts_created.append(self._insert_alert(alert_data))
                     logger.info(f"[v0] Created high congestion alert for junction {junction_id}")
                 except Exception as e:
                     logger.error(f"[v0] Error creating congestion alert: {e}")
 
             # Track vehicle stability
-            vehicle_key = f"junction_{junction_id}"
-            
-            if vehicle_key not in self.vehicle_tracking:
-                self.vehicle_tracking[vehicle_key] = {
-                    "first_detected": current_time,
-                    "vehicle_count": detections["vehicle_count"],
-                    "last_update": current_time
-                }
-            else:
-                # Update tracking
-                self.vehicle_tracking[vehicle_key]["last_update"] = current_time
-                self.vehicle_tracking[vehicle_key]["vehicle_count"] = detections["vehicle_count"]
-
-            # Check if vehicles have been stable for threshold
-            tracking_data = self.vehicle_tracking[vehicle_key]
-            duration = (current_time - tracking_data["first_detected"]).total_seconds() / 60
+            duration = self._track(junction_id, detections["vehicle_count"], now_ts)
+            self._prune_stale(now_ts)
 
             if duration > self.stable_threshold_minutes:
                 # Check if we already have an alert for this
@@ -86,16 +299,14 @@ class CongestionAnalyzer:
                             "stable_duration_minutes": int(duration),
                             "alert_status": "active"
                         }
-                        alert = self.supabase.table("congestion_alerts").insert(alert_data).execute()
-                        alerts_created.append(alert.data[0])
+                        alerts_created.append(self._insert_alert(alert_data))
                         logger.info(f"[v0] Created stable vehicle alert for junction {junction_id} (duration: {int(duration)}min)")
                     except Exception as e:
                         logger.error(f"[v0] Error creating stable vehicle alert: {e}")
             else:
                 # Reset if vehicle count decreased significantly
                 if detections["vehicle_count"] < 10:
-                    if vehicle_key in self.vehicle_tracking:
-                        del self.vehicle_tracking[vehicle_key]
+                    self._untrack(junction_id)
 
         except Exception as e:
             logger.error(f"[v0] Error in check_and_create_alerts: {e}")
@@ -107,41 +318,44 @@ class CongestionAnalyzer:
         Send notifications to assigned inspector and related users
         """
         try:
+            # Collect every notification row first, then insert them in one
+            # round trip instead of one request per recipient
+            notification_rows = []
+
+            # Overlap the three lookups; each is served from the TTL cache
+            # when this junction alerted recently
+            junction_future = self._lookup_pool.submit(
+                self._get_junction, alert_data["junction_id"])
+            officers_future = self._lookup_pool.submit(
+                self._get_officers, alert_data["junction_id"])
+
             # Get assigned inspector
             if alert_data.get("assigned_inspector_id"):
-                inspector = self.supabase.table("inspectors").select("*").eq(
-                    "id", alert_data["assigned_inspector_id"]
-                ).single().execute()
+                inspector_data = self._get_inspector(alert_data["assigned_inspector_id"])
 
-                inspector_data = inspector.data
-
-                # Create in-app notification
-                self.supabase.table("notifications").insert({
+                notification_rows.append({
                     "user_id": inspector_data["user_id"],
                     "alert_id": alert_id,
                     "notification_type": "in_app",
                     "message": f"New {alert_data['alert_type']} alert at your assigned junction"
-                }).execute()
+                })
 
                 # TODO: Send email and SMS using external services
-                logger.info(f"[v0] Notification sent to inspector {inspector_data['id']}")
+                logger.info(f"[v0] Notification queued for inspector {inspector_data['id']}")
 
             # Notify junction officer
-            junction = self.supabase.table("junctions").select("*").eq(
-                "id", alert_data["junction_id"]
-            ).single().execute()
+            junction = junction_future.result()
 
-            officers = self.supabase.table("users").select("*").eq(
-                "assigned_junction_id", alert_data["junction_id"]
-            ).eq("user_type", "officer").execute()
-
-            for officer in officers.data or []:
-                self.supabase.table("notifications").insert({
+            for officer in officers_future.result():
+                notification_rows.append({
                     "user_id": officer["id"],
                     "alert_id": alert_id,
                     "notification_type": "in_app",
-                    "message": f"Alert at {junction.data['name']}: {alert_data['alert_type']}"
-                }).execute()
+                    "message": f"Alert at {junction['name']}: {alert_data['alert_type']}"
+                })
+
+            if notification_rows:
+                self.supabase.table("notifications").insert(notification_rows).execute()
 
             return True
 
@@ -164,16 +378,38 @@ class CongestionAnalyzer:
             else:
                 start_date = datetime.now().date()
 
-            detections = self.supabase.table("vehicle_detections").select("*").eq(
-                "junction_id", junction_id
-            ).gte("created_at", str(start_date)).execute()
-
-            detection_data = detections.data or []
+            # Aggregate in the database (scripts/03) instead of pulling every
+            # detection row over the wire to sum it here
+            try:
+                stats_result = self.supabase.rpc("get_junction_report", {
+                    "jid": junction_id,
+                    "since": str(start_date)
+                }).execute()
 
-            # Calculate statistics
-            total_vehicles = sum(d["vehicle_count"] for d in detection_data)
-            avg_vehicles = total_vehicles / len(detection_data) if detection_data else 0
-            peak_vehicles = max((d["vehicle_count"] for d in detection_data), default=0)
+                stats = (stats_result.data or [{}])[0]
+                detection_count = stats.get("detection_count", 0)
+                total_vehicles = stats.get("total_vehicles", 0)
+                avg_vehicles = float(stats.get("average_vehicles", 0) or 0)
+                peak_vehicles = stats.get("peak_vehicles", 0)
+            except Exception:
+                # Fallback when the SQL function isn't deployed: fetch the
+                # rows and reduce them in one numpy pass rather than three
+                # Python-level sweeps
+                detections = self.supabase.table("vehicle_detections").select(
+                    "vehicle_count"
+                ).eq("junction_id", junction_id).gte(
+                    "created_at", str(start_date)
+                ).execute()
+
+                detection_data = detections.data or []
+                counts = np.fromiter(
+                    (d["vehicle_count"] for d in detection_data),
+                    dtype=np.int32, count=len(detection_data)
+                )
+                detection_count = len(counts)
+                total_vehicles = int(counts.sum()) if detection_count else 0
+                avg_vehicles = float(counts.mean()) if detection_count else 0
+                peak_vehicles = int(counts.max()) if detection_count else 0
 
             # Get alerts
             alerts = self.supabase.table("congestion_alerts").select("*").eq(
@@ -190,7 +426,7 @@ class CongestionAnalyzer:
                 "peak_vehicles": peak_vehicles,
                 "alerts_generated": len(alerts.data or []),
                 "report_data": {
-                    "detection_count": len(detection_data),
+                    "detection_count": detection_count,
                     "alert_details": [
                         {
                             "type": a.get("alert_type"),
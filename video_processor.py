@@ -3,11 +3,25 @@ Video Processing and Vehicle Detection Module
 Uses OpenCV and YOLO for real-time vehicle detection and congestion analysis
 """
 
+import os
+
+# Parallelism is managed at the feed/pipeline level; left to their own
+# defaults, OpenCV and OpenMP each spawn a thread per core for every
+# resize/encode call and fight the decode and inference threads for CPU.
+# OMP must be pinned before torch (via ultralytics) is imported.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
 import cv2
+
+cv2.setNumThreads(1)
+cv2.ocl.setUseOpenCL(False)
+
 import numpy as np
+import queue
+import time
 from ultralytics import YOLO
 import threading
-from collections import defaultdict
+from collections import deque
 from datetime import datetime, timedelta
 import json
 from typing import Dict, List, Tuple
@@ -16,6 +30,65 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Pairwise IoU matrix between two (N,4) and (M,4) xyxy box arrays"""
+    if a.size == 0 or b.size == 0:
+        return np.zeros((a.shape[0], b.shape[0]), dtype=np.float32)
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    wh = np.clip(bottom_right - top_left, 0, None)
+    intersection = wh[..., 0] * wh[..., 1]
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return intersection / np.maximum(union, 1e-6)
+
+def open_capture(source):
+    """Open a video source with hardware-accelerated decode when available
+
+    Asks FFMPEG for any HW acceleration (NVDEC/VAAPI/...) so H.264/HEVC
+    decode comes off the CPU cores; falls back to the default CPU capture
+    when the backend can't provide it.
+    """
+    try:
+        cap = cv2.VideoCapture(source, cv2.CAP_FFMPEG, [
+            cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY,
+            cv2.CAP_PROP_HW_DEVICE, 0,
+        ])
+        if cap.isOpened():
+            return cap
+    except cv2.error:
+        pass
+    return cv2.VideoCapture(source)
+
+def load_yolo_model(model_path: str = "yolov8n.pt"):
+    """Load YOLO, preferring a cached TensorRT FP16 engine on CUDA hosts
+
+    The engine (fused conv-bn-activation, Tensor Core FP16) roughly doubles
+    throughput over eager PyTorch. Export runs once per host — it takes a
+    couple of minutes — and the sibling .engine file is reused afterwards.
+    CPU-only hosts fall straight through to the .pt weights.
+    """
+    engine_path = os.path.splitext(model_path)[0] + '.engine'
+    if os.path.exists(engine_path):
+        return YOLO(engine_path, task='detect')
+
+    try:
+        import torch
+        has_cuda = torch.cuda.is_available()
+    except ImportError:
+        has_cuda = False
+
+    if has_cuda:
+        try:
+            YOLO(model_path).export(format='engine', half=True, imgsz=640,
+                                    batch=16, dynamic=True)
+            return YOLO(engine_path, task='detect')
+        except Exception as e:
+            logger.warning(f"[v0] TensorRT export failed, using PyTorch weights: {e}")
+
+    return YOLO(model_path)
+
 class VehicleDetector:
     """
     Main class for vehicle detection from video feeds
@@ -25,102 +98,134 @@ class VehicleDetector:
     def __init__(self, model_path: str = "yolov8n.pt"):
         """Initialize YOLO model"""
         try:
-            self.model = YOLO(model_path)
+            self.model = load_yolo_model(model_path)
             self.vehicle_classes = [2, 3, 5, 7]  # car, motorcycle, bus, truck
-            self.stable_vehicles = defaultdict(lambda: {"count": 0, "first_seen": None})
+            self._vehicle_classes_arr = np.array(self.vehicle_classes)
+            # Stability tracks as flat arrays: boxes and their first-seen
+            # times line up by index
+            self._track_boxes = np.empty((0, 4), dtype=np.float32)
+            self._track_first_seen = np.empty(0, dtype=np.float64)
+            # Timestamp overlay string, regenerated at most once per second
+            self._ts_cache = (0, "")
             logger.info("[v0] YOLO model loaded successfully")
         except Exception as e:
             logger.error(f"[v0] Error loading YOLO model: {e}")
             raise
 
+    def _parse_result(self, result) -> Dict:
+        """
+        Convert one YOLO result into the detections dict shared by the
+        single-frame and batched paths
+        """
+        # Pull class/confidence/bbox as whole arrays in one device-to-host
+        # copy; per-box element access syncs the GPU once per detection
+        boxes = result.boxes
+        cls = boxes.cls.cpu().numpy().astype(np.int32)
+        conf = boxes.conf.cpu().numpy()
+        xyxy = boxes.xyxy.cpu().numpy()
+
+        mask = np.isin(cls, self._vehicle_classes_arr)
+        cls, conf, xyxy = cls[mask], conf[mask], xyxy[mask]
+
+        # Count per class with one bincount over the int IDs; class names
+        # only materialize here, at the output boundary
+        counts = np.bincount(cls, minlength=8)[self._vehicle_classes_arr]
+        vehicle_types = {
+            self.VEHICLE_TYPE_NAMES[class_id]: int(count)
+            for class_id, count in zip(self.vehicle_classes, counts.tolist())
+            if count
+        }
+
+        type_names = self.VEHICLE_TYPE_NAMES
+        detection_list = [
+            {"type": type_names[class_id], "confidence": confidence, "bbox": bbox}
+            for class_id, confidence, bbox in zip(cls.tolist(), conf.tolist(),
+                                                  xyxy.tolist())
+        ]
+
+        return {
+            "vehicle_count": int(cls.size),
+            "vehicle_types": vehicle_types,
+            "detections": detection_list,
+            # Per-box confidences already live in detection_list; only the
+            # single-pass mean leaves this function
+            "avg_confidence": float(conf.mean()) if conf.size else 0
+        }
+
     def detect_vehicles(self, frame: np.ndarray) -> Dict:
         """
         Detect vehicles in a frame using YOLO
-        Returns detected vehicles, count, types, and confidence scores
+        Returns detected vehicles, count, types, and average confidence
         """
         try:
-            results = self.model(frame, conf=0.5, verbose=False)
-            
-            detections = {
+            results = self.model(frame, imgsz=640, conf=0.5, verbose=False)
+            return self._parse_result(results[0])
+
+        except Exception as e:
+            logger.error(f"[v0] Error in vehicle detection: {e}")
+            return {
                 "vehicle_count": 0,
-                "vehicle_types": defaultdict(int),
+                "vehicle_types": {},
                 "detections": [],
-                "confidence_scores": []
+                "avg_confidence": 0
             }
 
-            for result in results:
-                for box in result.boxes:
-                    cls = int(box.cls[0])
-                    conf = float(box.conf[0])
-                    
-                    if cls in self.vehicle_classes:
-                        detections["vehicle_count"] += 1
-                        detections["confidence_scores"].append(conf)
-                        
-                        vehicle_type = self._get_vehicle_type(cls)
-                        detections["vehicle_types"][vehicle_type] += 1
-                        
-                        # Get bounding box coordinates
-                        x1, y1, x2, y2 = box.xyxy[0]
-                        detections["detections"].append({
-                            "type": vehicle_type,
-                            "confidence": conf,
-                            "bbox": [float(x1), float(y1), float(x2), float(y2)]
-                        })
-
-            # Calculate average confidence
-            if detections["confidence_scores"]:
-                detections["avg_confidence"] = sum(detections["confidence_scores"]) / len(detections["confidence_scores"])
-            else:
-                detections["avg_confidence"] = 0
-
-            detections["vehicle_types"] = dict(detections["vehicle_types"])
-            return detections
+    def detect_vehicles_batch(self, frames: List[np.ndarray]) -> List[Dict]:
+        """
+        Run YOLO over a window of frames in one call
 
+        Batching amortizes the kernel launch and host-to-device copy that
+        dominate small per-frame inference; one result dict per input frame.
+        """
+        try:
+            results = self.model(frames, imgsz=640, conf=0.5, verbose=False)
+            return [self._parse_result(result) for result in results]
         except Exception as e:
-            logger.error(f"[v0] Error in vehicle detection: {e}")
-            return {
+            logger.error(f"[v0] Error in batched vehicle detection: {e}")
+            return [{
                 "vehicle_count": 0,
                 "vehicle_types": {},
                 "detections": [],
                 "avg_confidence": 0
-            }
+            } for _ in frames]
 
     def detect_stable_vehicles(self, detections: Dict, frame_id: int = 0, stability_threshold: int = 10) -> List[Dict]:
         """
         Detect vehicles that have been stable (not moving) for longer than threshold minutes
         This indicates potential congestion or bottleneck situations
+
+        Current boxes are matched against the tracked set with one
+        vectorized IoU matrix; a match (IoU >= 0.5) inherits the track's
+        first-seen time, so sub-pixel jitter no longer resets the clock
+        the way the old exact-coordinate keys did. Unmatched tracks age
+        out with the frame that lost them.
         """
-        stable_alerts = []
-        current_time = datetime.now()
+        now = time.monotonic()
+        current = np.asarray(
+            [d["bbox"] for d in detections.get("detections", [])],
+            dtype=np.float32
+        ).reshape(-1, 4)
+
+        first_seen = np.full(len(current), now, dtype=np.float64)
+        iou = _box_iou(current, self._track_boxes)
+        if iou.size:
+            best_track = iou.argmax(axis=1)
+            matched = iou[np.arange(len(current)), best_track] >= 0.5
+            first_seen[matched] = self._track_first_seen[best_track[matched]]
+
+        self._track_boxes = current
+        self._track_first_seen = first_seen
 
-        for detection in detections.get("detections", []):
-            vehicle_key = f"{frame_id}_{detection['bbox'][0]}_{detection['bbox'][1]}"
-            
-            if vehicle_key not in self.stable_vehicles:
-                self.stable_vehicles[vehicle_key] = {
-                    "count": 1,
-                    "first_seen": current_time,
-                    "bbox": detection["bbox"]
-                }
-            else:
-                self.stable_vehicles[vehicle_key]["count"] += 1
-
-        # Check for vehicles stable for longer than threshold
-        for vehicle_key, vehicle_info in list(self.stable_vehicles.items()):
-            if vehicle_info["first_seen"]:
-                duration = (current_time - vehicle_info["first_seen"]).total_seconds() / 60
-                
-                if duration > stability_threshold:
-                    stable_alerts.append({
-                        "vehicle_key": vehicle_key,
-                        "stable_duration_minutes": int(duration),
-                        "bbox": vehicle_info["bbox"],
-                        "severity": "high" if duration > 20 else "medium"
-                    })
-                elif duration < stability_threshold - 5:
-                    # Clean up old entries
-                    del self.stable_vehicles[vehicle_key]
+        stable_alerts = []
+        durations = (now - first_seen) / 60
+        for index in np.nonzero(durations > stability_threshold)[0]:
+            duration = durations[index]
+            stable_alerts.append({
+                "vehicle_key": f"{frame_id}_track_{index}",
+                "stable_duration_minutes": int(duration),
+                "bbox": current[index].tolist(),
+                "severity": "high" if duration > 20 else "medium"
+            })
 
         return stable_alerts
 
@@ -159,83 +264,195 @@ class VehicleDetector:
     def draw_detections(self, frame: np.ndarray, detections: Dict) -> np.ndarray:
         """
         Draw bounding boxes and vehicle count on frame for visualization
-        """
-        annotated_frame = frame.copy()
-        height, width = frame.shape[:2]
-        
-        # Draw vehicle detections
-        for detection in detections.get("detections", []):
-            x1, y1, x2, y2 = [int(coord) for coord in detection["bbox"]]
-            confidence = detection["confidence"]
-            vehicle_type = detection["type"]
-            
-            # Draw bounding box
-            color = (0, 165, 255)  # Orange
-            cv2.rectangle(annotated_frame, (x1, y1), (x2, y2), color, 2)
-            
-            # Draw label
-            label = f"{vehicle_type} ({confidence:.2f})"
-            cv2.putText(annotated_frame, label, (x1, y1 - 10),
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
 
-        # Draw vehicle count and timestamp
-        cv2.putText(annotated_frame, f"Vehicles: {detections['vehicle_count']}", (10, 30),
+        Annotates in place (no caller needs the clean frame afterwards,
+        and the copy was a full-frame memcpy per annotated frame) and
+        draws every rectangle with one polylines call instead of one
+        OpenCV call per box.
+        """
+        color = (0, 165, 255)  # Orange
+
+        detection_list = detections.get("detections", [])
+        if detection_list:
+            boxes = np.asarray([d["bbox"] for d in detection_list], dtype=np.int32)
+            # Rectangles as (N,4,2) corner arrays, one call for all of them
+            corners = np.stack([
+                boxes[:, [0, 1]], boxes[:, [2, 1]],
+                boxes[:, [2, 3]], boxes[:, [0, 3]],
+            ], axis=1)
+            cv2.polylines(frame, corners, True, color, 2)
+
+            # Draw labels
+            for detection, box in zip(detection_list, boxes):
+                label = f"{detection['type']} ({detection['confidence']:.2f})"
+                cv2.putText(frame, label, (int(box[0]), int(box[1]) - 10),
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+
+        # Draw vehicle count and timestamp; strftime with tz lookup is
+        # surprisingly hot at 30 fps, so the string refreshes once per second
+        second = int(time.time())
+        if second != self._ts_cache[0]:
+            self._ts_cache = (second, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+        cv2.putText(frame, f"Vehicles: {detections['vehicle_count']}", (10, 30),
                    cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-        cv2.putText(annotated_frame, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), (10, 70),
+        cv2.putText(frame, self._ts_cache[1], (10, 70),
                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (200, 200, 200), 1)
 
-        return annotated_frame
+        return frame
+
+    # Class-id to name mapping, built once instead of per lookup
+    VEHICLE_TYPE_NAMES = {
+        2: "car",
+        3: "motorcycle",
+        5: "bus",
+        7: "truck"
+    }
 
-    @staticmethod
-    def _get_vehicle_type(class_id: int) -> str:
+    @classmethod
+    def _get_vehicle_type(cls, class_id: int) -> str:
         """Map YOLO class ID to vehicle type"""
-        vehicle_types = {
-            2: "car",
-            3: "motorcycle",
-            5: "bus",
-            7: "truck"
-        }
-        return vehicle_types.get(class_id, "unknown")
+        return cls.VEHICLE_TYPE_NAMES.get(class_id, "unknown")
 
-    def process_video_file(self, video_path: str, callback=None) -> Dict:
-        """
-        Process a video file and return statistics
-        Callback function called with detections for each frame
-        """
-        try:
-            cap = cv2.VideoCapture(video_path)
-            if not cap.isOpened():
-                raise ValueError(f"Cannot open video file: {video_path}")
+    def _run_pipeline(self, cap, callback, batch_size: int, frame_stride: int,
+                      max_frames: int = None, progress_total: int = None):
+        """Run the decode/infer/callback pipeline over an open capture
 
-            fps = cap.get(cv2.CAP_PROP_FPS)
-            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            frame_count = 0
-            total_vehicles = 0
-            peak_vehicles = 0
-            all_detections = []
+        Three stages: a reader thread decodes ahead of the model, this
+        thread runs batched inference, and a writer thread invokes the
+        callback. While the model chews on frame N, frame N+1 is being
+        decoded and the results for N-1 are being written out.
 
-            while cap.isOpened():
+        Only every frame_stride-th frame is inferred; consecutive frames
+        are near-duplicates for traffic counting, and skipped frames cost
+        one cheap cap.grab() instead of a full decode-to-BGR.
+
+        Returns (frame_count, total_vehicles, peak_vehicles,
+        all_detections). The capture is always released and both worker
+        threads are always joined, even when inference raises.
+        """
+        frame_count = 0
+        total_vehicles = 0
+        peak_vehicles = 0
+        # Rolling window: only the last 100 frames' detections are ever
+        # returned, so keeping every frame's dicts alive for an hour-long
+        # video was pure heap growth
+        all_detections = deque(maxlen=100)
+        batch_frames = []
+        batch_indices = []
+
+        stop_event = threading.Event()
+        read_q = queue.Queue(maxsize=2 * batch_size)
+        write_q = queue.Queue(maxsize=2 * batch_size)
+
+        def reader():
+            index = 0
+            sampled = 0
+            while cap.isOpened() and not stop_event.is_set():
+                if max_frames is not None and sampled >= max_frames:
+                    break
                 ret, frame = cap.read()
                 if not ret:
                     break
-
-                # Resize for faster processing
-                frame = cv2.resize(frame, (640, 480))
-                
-                detections = self.detect_vehicles(frame)
+                # Full frame: YOLO letterboxes to imgsz=640 itself, so a
+                # CPU resize here is redundant work (and the 640x480
+                # squash distorted aspect ratio)
+                read_q.put((index, frame))
+                sampled += 1
+                index += frame_stride
+                for _ in range(frame_stride - 1):
+                    if not cap.grab():
+                        break
+            read_q.put(None)
+
+        def writer():
+            while True:
+                item = write_q.get()
+                if item is None:
+                    break
+                detections, index = item
+                if callback:
+                    try:
+                        callback(detections, index)
+                    except Exception as e:
+                        # A failing callback must not kill this thread:
+                        # the bounded queue would fill and wedge the
+                        # whole pipeline behind it
+                        logger.error(f"[v0] Error in detection callback: {e}")
+
+        reader_thread = threading.Thread(target=reader, daemon=True)
+        writer_thread = threading.Thread(target=writer, daemon=True)
+        reader_thread.start()
+        writer_thread.start()
+
+        def flush_batch():
+            nonlocal total_vehicles, peak_vehicles
+            for index, detections in zip(batch_indices,
+                                         self.detect_vehicles_batch(batch_frames)):
                 total_vehicles += detections["vehicle_count"]
                 peak_vehicles = max(peak_vehicles, detections["vehicle_count"])
                 all_detections.append(detections)
+                write_q.put((detections, index))
+            batch_frames.clear()
+            batch_indices.clear()
 
-                if callback:
-                    callback(detections, frame_count)
+        try:
+            while True:
+                item = read_q.get()
+                if item is None:
+                    break
+                index, frame = item
 
-                frame_count += 1
-                if frame_count % 30 == 0:
-                    logger.info(f"[v0] Processed {frame_count}/{total_frames} frames")
+                batch_frames.append(frame)
+                batch_indices.append(index)
+                if len(batch_frames) == batch_size:
+                    flush_batch()
 
+                frame_count += 1
+                if progress_total is not None and frame_count % 30 == 0:
+                    logger.info(f"[v0] Processed {frame_count}/{progress_total} frames")
+
+            if batch_frames:
+                flush_batch()
+        finally:
+            # Unwind even on error: stop the reader and drain its queue so
+            # it can't sit blocked on a full put, then let the writer run
+            # dry — otherwise an exception here leaks threads and keeps
+            # the capture open
+            stop_event.set()
+            while reader_thread.is_alive():
+                try:
+                    read_q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            reader_thread.join()
+            write_q.put(None)
+            writer_thread.join()
             cap.release()
 
+        return frame_count, total_vehicles, peak_vehicles, all_detections
+
+    def process_video_file(self, video_path: str, callback=None,
+                           batch_size: int = 16, frame_stride: int = 5) -> Dict:
+        """
+        Process a video file and return statistics
+
+        Work runs through the pipelined stages of _run_pipeline; this
+        wrapper only opens the file and shapes the result dict.
+        """
+        try:
+            cap = open_capture(video_path)
+            if not cap.isOpened():
+                cap.release()
+                raise ValueError(f"Cannot open video file: {video_path}")
+
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+            frame_count, total_vehicles, peak_vehicles, all_detections = \
+                self._run_pipeline(cap, callback, batch_size, frame_stride,
+                                   progress_total=total_frames)
+
             avg_vehicles = total_vehicles / max(frame_count, 1)
             duration_seconds = total_frames / fps if fps > 0 else 0
 
@@ -247,7 +464,7 @@ class VehicleDetector:
                 "total_vehicles": total_vehicles,
                 "average_vehicles": avg_vehicles,
                 "peak_vehicles": peak_vehicles,
-                "detections": all_detections[:100]  # Return first 100 for efficiency
+                "detections": list(all_detections)  # Last 100 frames' worth
             }
 
         except Exception as e:
@@ -284,38 +501,23 @@ class VehicleDetector:
                 "error": str(e)
             }
 
-    def process_stream(self, stream_url: str, callback=None, max_frames: int = 300) -> Dict:
+    def process_stream(self, stream_url: str, callback=None, max_frames: int = 300,
+                       batch_size: int = 16, frame_stride: int = 5) -> Dict:
         """
-        Process a live stream or HTTP stream
+        Process a live stream or HTTP stream with the same pipelined
+        stages as process_video_file, capped at max_frames sampled
+        frames; grabbing (not reading) the skipped frames also keeps a
+        live source from backing up behind inference
         """
         try:
-            cap = cv2.VideoCapture(stream_url)
+            cap = open_capture(stream_url)
             if not cap.isOpened():
+                cap.release()
                 raise ValueError(f"Cannot open stream: {stream_url}")
 
-            frame_count = 0
-            total_vehicles = 0
-            peak_vehicles = 0
-            all_detections = []
-
-            while cap.isOpened() and frame_count < max_frames:
-                ret, frame = cap.read()
-                if not ret:
-                    break
-
-                frame = cv2.resize(frame, (640, 480))
-                detections = self.detect_vehicles(frame)
-                
-                total_vehicles += detections["vehicle_count"]
-                peak_vehicles = max(peak_vehicles, detections["vehicle_count"])
-                all_detections.append(detections)
-
-                if callback:
-                    callback(detections, frame_count)
-
-                frame_count += 1
-
-            cap.release()
+            frame_count, total_vehicles, peak_vehicles, all_detections = \
+                self._run_pipeline(cap, callback, batch_size, frame_stride,
+                                   max_frames=max_frames)
 
             return {
                 "success": True,
@@ -323,7 +525,7 @@ class VehicleDetector:
                 "total_vehicles": total_vehicles,
                 "average_vehicles": total_vehicles / max(frame_count, 1),
                 "peak_vehicles": peak_vehicles,
-                "detections": all_detections
+                "detections": list(all_detections)
             }
 
         except Exception as e:
@@ -347,17 +549,29 @@ class VideoProcessor:
     async def process_and_store(self, video_path: str, junction_id: int, video_feed_id: int = None) -> Dict:
         """
         Process video and store detections in database
+
+        Rows are buffered and flushed in batches of 100 so the pipeline
+        isn't throttled to one HTTP round trip per frame.
         """
+        pending = []
+
+        def flush_pending():
+            if pending:
+                self.supabase.table("vehicle_detections").insert(pending).execute()
+                pending.clear()
+
         def detection_callback(detections, frame_num):
-            # Store in database
-            self.supabase.table("vehicle_detections").insert({
+            pending.append({
                 "junction_id": junction_id,
                 "video_feed_id": video_feed_id,
                 "vehicle_count": detections["vehicle_count"],
                 "vehicle_types": detections["vehicle_types"],
                 "confidence_score": detections.get("avg_confidence", 0),
                 "is_congested": detections["vehicle_count"] > 30
-            }).execute()
+            })
+            if len(pending) >= 100:
+                flush_pending()
 
         result = self.detector.process_video_file(video_path, callback=detection_callback)
+        flush_pending()
         return result
@@ -1,22 +1,76 @@
+import os
+
+# Pin OpenCV/OpenMP to one thread each: feed-level concurrency is the
+# parallelism model here, and per-call thread pools only add jitter.
+# OMP must be set before torch comes in through ultralytics
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
 import cv2
+
+cv2.setNumThreads(1)
+cv2.ocl.setUseOpenCL(False)
+
 import numpy as np
+import threading
 from ultralytics import YOLO
 from typing import Dict, List, Tuple
 import time
 from datetime import datetime
 
+# Shared model handles keyed by path: the weights are ~100MB (and VRAM on
+# GPU hosts), so feeds must not load their own copy. Only the model is
+# shared — analyzer instances, and the mutable tracking state they carry,
+# are per feed
+_MODELS = {}
+_MODELS_LOCK = threading.Lock()
+
+def _get_model(model_path: str = 'yolov8n.pt'):
+    """Return the shared model for model_path, loading it once"""
+    with _MODELS_LOCK:
+        model = _MODELS.get(model_path)
+        if model is None:
+            model = _load_model(model_path)
+            _MODELS[model_path] = model
+        return model
+
+def _load_model(model_path: str = 'yolov8n.pt'):
+    """Use a cached TensorRT FP16 engine when one exists (or can be built
+    on a CUDA host); otherwise load the PyTorch weights"""
+    engine_path = os.path.splitext(model_path)[0] + '.engine'
+    if os.path.exists(engine_path):
+        return YOLO(engine_path, task='detect')
+
+    try:
+        import torch
+        if torch.cuda.is_available():
+            YOLO(model_path).export(format='engine', half=True, imgsz=640,
+                                    batch=16, dynamic=True)
+            return YOLO(engine_path, task='detect')
+    except Exception:
+        pass
+
+    return YOLO(model_path)
+
 class OpenCVAnalyzer:
-    def __init__(self):
-        self.model = YOLO('yolov8n.pt')  # Load YOLOv8 nano model
+    """Per-feed analyzer over a shared model handle
+
+    Instances are cheap — the heavy model comes from the module cache
+    (inference serializes on the GPU regardless, and model calls are
+    thread-safe) — while stable_vehicles stays instance state, so vehicle
+    IDs from different feeds never collide in one tracker.
+    """
+    def __init__(self, model_path: str = 'yolov8n.pt'):
+        self.model = _get_model(model_path)  # YOLOv8 nano, TensorRT when available
         self.vehicle_classes = {
             2: 'car',
             3: 'motorbike',
             5: 'bus',
             7: 'truck'
         }
+        self._class_id_arr = np.array(list(self.vehicle_classes))
         self.stable_vehicles = {}  # Track vehicles stable for 10+ mins
         self.stable_threshold_seconds = 600  # 10 minutes
-        
+
     def process_video(self, video_path: str) -> Dict:
         """Process video and extract traffic metrics"""
         cap = cv2.VideoCapture(video_path)
@@ -46,19 +100,24 @@ class OpenCVAnalyzer:
             
             # Detect vehicles
             results = self.model(frame)
-            
+
             for result in results:
-                boxes = result.boxes
-                for box in boxes:
-                    cls = int(box.cls[0])
-                    conf = float(box.conf[0])
-                    
-                    if cls in self.vehicle_classes:
-                        vehicle_type = self.vehicle_classes[cls]
+                # One device-to-host copy per frame instead of per box
+                cls = result.boxes.cls.cpu().numpy().astype(np.int32)
+                conf = result.boxes.conf.cpu().numpy()
+                mask = np.isin(cls, self._class_id_arr)
+                cls, conf = cls[mask], conf[mask]
+
+                # bincount keeps the tally on int IDs; names only at the end
+                counts = np.bincount(cls, minlength=8)[self._class_id_arr]
+                for class_id, count in zip(self._class_id_arr.tolist(),
+                                           counts.tolist()):
+                    if count:
+                        vehicle_type = self.vehicle_classes[class_id]
                         vehicle_data['vehicle_types'][vehicle_type] = \
-                            vehicle_data['vehicle_types'].get(vehicle_type, 0) + 1
-                        vehicle_data['total_vehicles'] += 1
-                        total_confidence += conf
+                            vehicle_data['vehicle_types'].get(vehicle_type, 0) + count
+                vehicle_data['total_vehicles'] += int(cls.size)
+                total_confidence += float(conf.sum())
         
         vehicle_data['frames_processed'] = frame_count
         if vehicle_data['total_vehicles'] > 0:
@@ -87,55 +146,86 @@ class OpenCVAnalyzer:
         }
         
         for result in results:
-            boxes = result.boxes
-            for box in boxes:
-                cls = int(box.cls[0])
-                conf = float(box.conf[0])
-                x1, y1, x2, y2 = box.xyxy[0]
-                
-                if cls in self.vehicle_classes:
-                    vehicle_type = self.vehicle_classes[cls]
-                    detections['vehicle_count'] += 1
-                    detections['vehicle_types'][vehicle_type] = \
-                        detections['vehicle_types'].get(vehicle_type, 0) + 1
-                    
-                    detections['detections'].append({
-                        'type': vehicle_type,
-                        'confidence': conf,
-                        'bbox': [float(x1), float(y1), float(x2), float(y2)]
-                    })
+            cls = result.boxes.cls.cpu().numpy().astype(np.int32)
+            conf = result.boxes.conf.cpu().numpy()
+            xyxy = result.boxes.xyxy.cpu().numpy()
+            mask = np.isin(cls, self._class_id_arr)
+            cls, conf, xyxy = cls[mask], conf[mask], xyxy[mask]
+
+            detections['vehicle_count'] += int(cls.size)
+            for class_id, confidence, bbox in zip(cls.tolist(), conf.tolist(),
+                                                  xyxy.tolist()):
+                vehicle_type = self.vehicle_classes[class_id]
+                detections['vehicle_types'][vehicle_type] = \
+                    detections['vehicle_types'].get(vehicle_type, 0) + 1
+
+                detections['detections'].append({
+                    'type': vehicle_type,
+                    'confidence': confidence,
+                    'bbox': bbox
+                })
         
         return detections
     
     def detect_stable_vehicles(self, vehicle_positions: List[Dict]) -> int:
-        """Detect vehicles stationary for > 10 minutes"""
+        """Detect vehicles stationary for > 10 minutes
+
+        The per-vehicle distance math runs as one vectorized pass: marshal
+        tracked positions and timers into arrays, compute every displacement
+        with a single hypot, then write back only the tracks that moved.
+        """
         current_time = time.time()
-        stable_count = 0
-        
-        for vehicle in vehicle_positions:
-            vehicle_id = vehicle['id']
-            position = vehicle['position']
-            
-            if vehicle_id not in self.stable_vehicles:
+        if not vehicle_positions:
+            return 0
+
+        ids = [vehicle['id'] for vehicle in vehicle_positions]
+        positions = np.asarray(
+            [vehicle['position'] for vehicle in vehicle_positions],
+            dtype=np.float32
+        )
+
+        prev_positions = np.empty_like(positions)
+        start_times = np.empty(len(ids), dtype=np.float64)
+        is_new = np.zeros(len(ids), dtype=bool)
+        for i, vehicle_id in enumerate(ids):
+            track = self.stable_vehicles.get(vehicle_id)
+            if track is None:
+                is_new[i] = True
+                prev_positions[i] = positions[i]
+                start_times[i] = current_time
+            else:
+                prev_positions[i] = track['position']
+                start_times[i] = track['start_time']
+
+        deltas = positions - prev_positions
+        distances = np.hypot(deltas[:, 0], deltas[:, 1])
+        moved = (distances >= 10) & ~is_new  # 10+ pixels of movement
+
+        stationary = ~moved & ~is_new
+        stable_count = int(
+            (stationary & (current_time - start_times > self.stable_threshold_seconds)).sum()
+        )
+
+        # New vehicles start a timer; moved vehicles reset theirs; touched
+        # stationary tracks just refresh their last-seen stamp
+        for i, vehicle_id in enumerate(ids):
+            if is_new[i] or moved[i]:
                 self.stable_vehicles[vehicle_id] = {
-                    'position': position,
-                    'start_time': current_time
+                    'position': (float(positions[i, 0]), float(positions[i, 1])),
+                    'start_time': current_time,
+                    'last_seen': current_time
                 }
             else:
-                # Check if position changed significantly
-                prev_pos = self.stable_vehicles[vehicle_id]['position']
-                distance = np.sqrt((position[0] - prev_pos[0])**2 + 
-                                 (position[1] - prev_pos[1])**2)
-                
-                if distance < 10:  # Less than 10 pixels movement
-                    time_elapsed = current_time - self.stable_vehicles[vehicle_id]['start_time']
-                    if time_elapsed > self.stable_threshold_seconds:
-                        stable_count += 1
-                else:
-                    # Vehicle moved, reset timer
-                    self.stable_vehicles[vehicle_id] = {
-                        'position': position,
-                        'start_time': current_time
-                    }
-        
+                self.stable_vehicles[vehicle_id]['last_seen'] = current_time
+
+        # Sweep out tracks that vanished from the feed so the store stays
+        # bounded instead of growing one entry per vehicle ever seen
+        if len(self.stable_vehicles) > 2 * len(ids):
+            cutoff = current_time - 2 * self.stable_threshold_seconds
+            self.stable_vehicles = {
+                vehicle_id: track
+                for vehicle_id, track in self.stable_vehicles.items()
+                if track.get('last_seen', track['start_time']) >= cutoff
+            }
+
         return stable_count
@@ -1,15 +1,33 @@
 import cv2
 import numpy as np
 import os
+import queue
 import threading
+import time
+from contextlib import contextmanager
 from typing import Dict, Optional
 import yt_dlp
 import requests
 from datetime import datetime
+from psycopg2.extras import execute_values
 import logging
 
 logger = logging.getLogger(__name__)
 
+def _open_capture(source):
+    """cv2.VideoCapture with hardware decode (NVDEC/VAAPI) when the FFMPEG
+    backend supports it, plain CPU capture otherwise"""
+    try:
+        cap = cv2.VideoCapture(source, cv2.CAP_FFMPEG, [
+            cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY,
+            cv2.CAP_PROP_HW_DEVICE, 0,
+        ])
+        if cap.isOpened():
+            return cap
+    except cv2.error:
+        pass
+    return cv2.VideoCapture(source)
+
 class VideoHandler:
     """Base class for different video source types"""
     
@@ -35,7 +53,7 @@ class UploadedVideoHandler(VideoHandler):
         if not os.path.exists(self.file_path):
             raise FileNotFoundError(f"Video file not found: {self.file_path}")
         
-        self.cap = cv2.VideoCapture(self.file_path)
+        self.cap = _open_capture(self.file_path)
         if not self.cap.isOpened():
             raise Exception(f"Failed to open video: {self.file_path}")
         
@@ -63,8 +81,11 @@ class YouTubeVideoHandler(VideoHandler):
         
     def get_video_stream(self):
         try:
+            # Prefer H.264 so the hardware decoder can pick the stream up
+            max_height = int(self.quality[:-1])
             ydl_opts = {
-                'format': f'best[ext=mp4][height<={int(self.quality[:-1])}]',
+                'format': (f'best[ext=mp4][vcodec^=avc1][height<={max_height}]'
+                           f'/best[ext=mp4][height<={max_height}]'),
                 'quiet': True,
                 'no_warnings': True,
             }
@@ -73,7 +94,7 @@ class YouTubeVideoHandler(VideoHandler):
                 info = ydl.extract_info(self.youtube_url, download=False)
                 self.video_stream_url = info['url']
             
-            self.cap = cv2.VideoCapture(self.video_stream_url)
+            self.cap = _open_capture(self.video_stream_url)
             if not self.cap.isOpened():
                 raise Exception("Failed to open YouTube video stream")
             
@@ -107,7 +128,7 @@ class CCTVCameraHandler(VideoHandler):
         
         for url in stream_urls:
             try:
-                self.cap = cv2.VideoCapture(url)
+                self.cap = _open_capture(url)
                 if self.cap.isOpened():
                     self.stream_url = url
                     self.frame_rate = self.cap.get(cv2.CAP_PROP_FPS) or 30
@@ -149,22 +170,28 @@ class VideoProcessor:
             self.is_processing = True
             
             while self.is_processing and not self.stop_event.is_set():
-                ret, frame = cap.read()
-                if not ret:
+                # grab() only demuxes; the decode + YUV->BGR conversion is
+                # deferred to retrieve() and paid for sampled frames only
+                if not cap.grab():
                     logger.info("Video stream ended or failed")
                     break
-                
+
                 self.frame_count += 1
-                
-                # Resize frame for processing efficiency
-                processed_frame = cv2.resize(frame, (640, 480))
-                
+
+                # Every 30th frame is actually decoded and handed on
+                if self.frame_count % 30 != 0:
+                    continue
+
+                ret, frame = cap.retrieve()
+                if not ret:
+                    continue
+
+                # Pass the full frame through: YOLO letterboxes to its own
+                # input size, so resizing here just burns a CPU pass
                 if callback:
-                    callback(processed_frame, self.frame_count)
-                
-                # Yield frame every 30th frame to reduce overhead
-                if self.frame_count % 30 == 0:
-                    yield processed_frame, self.frame_count
+                    callback(frame, self.frame_count)
+
+                yield frame, self.frame_count
         
         finally:
             self.video_handler.release()
@@ -175,20 +202,95 @@ class VideoProcessor:
         self.is_processing = False
         self.stop_event.set()
     
+    # Encode-parameter lists reused across frames, keyed by quality
+    _jpeg_params = {}
+
     def compress_frame(self, frame: np.ndarray, quality: int = 80) -> bytes:
-        """Compress frame to JPEG bytes for streaming"""
-        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        """Compress frame to JPEG bytes for streaming
+
+        Stock opencv-python ships no NVJPEG/CUDA JPEG encoder binding, so
+        this stays on the CPU; the per-call parameter list is cached since
+        this runs once per streamed frame.
+        """
+        params = self._jpeg_params.get(quality)
+        if params is None:
+            params = self._jpeg_params[quality] = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        ret, buffer = cv2.imencode('.jpg', frame, params)
         if ret:
             return buffer.tobytes()
         return None
 
 class VideoAnalysisService:
-    """Service to manage multiple video streams and analysis"""
-    
-    def __init__(self, db_connection):
-        self.db_connection = db_connection
+    """Service to manage multiple video streams and analysis
+
+    Intended to live as a process-wide singleton: active_processors and
+    analysis_results must outlive any single request, and background
+    processing threads check their own connections out of the pool.
+    """
+
+    # Writer drains the queue in batches of up to this many rows, or
+    # whatever arrived within its 2-second window
+    SAVE_BATCH_SIZE = 100
+
+    # Feed threads share one model, so without explicit CUDA streams their
+    # inference calls all land on the default stream and serialize. Each
+    # slot in the pool carries its own stream (None on CPU-only hosts) and
+    # doubles as a concurrency cap so many feeds can't oversubscribe the GPU
+    MAX_CONCURRENT_INFERENCE = 4
+
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
         self.active_processors = {}
         self.analysis_results = {}
+        # Persistence runs on its own thread so detection loops never wait
+        # on the database
+        self._db_queue = queue.Queue(maxsize=10000)
+        threading.Thread(target=self._db_writer, name='analysis-writer',
+                         daemon=True).start()
+        self._inference_slots = queue.Queue()
+        for _ in range(self.MAX_CONCURRENT_INFERENCE):
+            self._inference_slots.put(self._make_stream())
+
+    @staticmethod
+    def _make_stream():
+        """One CUDA stream per inference slot; None when there is no GPU"""
+        try:
+            import torch
+            if torch.cuda.is_available():
+                return torch.cuda.Stream()
+        except ImportError:
+            pass
+        return None
+
+    @contextmanager
+    def _inference_slot(self):
+        """Check out a slot (and its stream) for one model call"""
+        stream = self._inference_slots.get()
+        try:
+            if stream is not None:
+                import torch
+                with torch.cuda.stream(stream):
+                    yield
+                stream.synchronize()
+            else:
+                yield
+        finally:
+            self._inference_slots.put(stream)
+
+    def _db_writer(self):
+        """Drain queued analysis rows, committing in batches"""
+        while True:
+            rows = [self._db_queue.get()]
+            deadline = time.time() + 2.0
+            while len(rows) < self.SAVE_BATCH_SIZE:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._db_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush_analysis_rows(rows)
         
     def add_youtube_feed(self, junction_id: str, youtube_url: str, feed_name: str):
         """Add YouTube feed"""
@@ -258,12 +360,15 @@ class VideoAnalysisService:
     def _process_feed(self, feed_id: str, processor: VideoProcessor):
         """Process feed and store results"""
         from backend.video_processor.opencv_analyzer import OpenCVAnalyzer
-        
+
+        # Per-feed analyzer so tracking state is isolated; the model behind
+        # it comes from the module cache, so the weights still load once
         analyzer = OpenCVAnalyzer()
         
         for frame, frame_count in processor.process_video_stream():
             try:
-                detections = analyzer.process_frame(frame)
+                with self._inference_slot():
+                    detections = analyzer.process_frame(frame)
                 
                 # Store results every 30 frames
                 if frame_count % 30 == 0:
@@ -282,20 +387,32 @@ class VideoAnalysisService:
                 logger.error(f"Error processing frame in feed {feed_id}: {e}")
     
     def _save_analysis_result(self, feed_id: str, junction_id: str, detections: Dict):
-        """Save analysis results to database"""
+        """Hand an analysis row to the writer thread; never blocks"""
         try:
-            cursor = self.db_connection.cursor()
-            cursor.execute("""
-                INSERT INTO traffic_analysis_results 
-                (junction_id, feed_id, analysis_timestamp, vehicle_count, vehicle_types)
-                VALUES (%s, %s, NOW(), %s, %s)
-            """, (junction_id, feed_id, detections['vehicle_count'], 
-                  str(detections['vehicle_types'])))
-            
-            self.db_connection.commit()
-            cursor.close()
+            self._db_queue.put_nowait((junction_id, feed_id,
+                                       detections['vehicle_count'],
+                                       str(detections['vehicle_types'])))
+        except queue.Full:
+            logger.warning(f"Analysis write queue full; dropping row for {feed_id}")
+
+    def _flush_analysis_rows(self, rows):
+        """Write buffered analysis rows in one transaction"""
+        if not rows:
+            return
+        conn = self.db_pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                execute_values(cursor, """
+                    INSERT INTO traffic_analysis_results
+                    (junction_id, feed_id, analysis_timestamp, vehicle_count, vehicle_types)
+                    VALUES %s
+                """, rows, template="(%s, %s, NOW(), %s, %s)")
+
+            conn.commit()
         except Exception as e:
-            logger.error(f"Error saving analysis result: {e}")
+            logger.error(f"Error saving analysis results: {e}")
+        finally:
+            self.db_pool.putconn(conn)
     
     def get_feed_results(self, feed_id: str) -> Dict:
         """Get latest results for a feed"""